@@ -0,0 +1,328 @@
+# IMPORTS
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import networkx as nx
+import numpy as np
+
+import city
+import geo
+import metro
+import restaurants
+from constants import STRIP_GRAPH
+
+# Constants
+RESULTS_FILE: str = "benchmark.json"
+SEED: int = 2022
+# Bounding box of the synthetic street grid, around Barcelona
+MIN_LAT, MAX_LAT = 41.35, 41.45
+MIN_LON, MAX_LON = 2.09, 2.23
+BLOCK: float = 110  # meters between crossings, as in the Eixample
+JITTER: float = 0.2  # of a block
+MISSING_STREETS: float = 0.03  # fraction of the streets removed
+BENT_STREETS: float = 0.3  # fraction with an extra node in the middle
+ROUTES: int = 200
+RENDERS: int = 10
+REPEAT: int = 3
+# Queries of /find, with the syntax of restaurants.find
+FIND_QUERIES: List[str] = [
+    "pizza", "sushi", "bar", "restaurant", "cafe", "kebab", "tapes",
+    "gracia", "diagonal", "xina", "pizzeria sants", "bar gracia",
+    "restaurant eixample", "and(pizza,not(sants))", "or(sushi,ramen)",
+    "and(bar,or(gracia,sants))", "piza", "restaurnt", "frankfurt",
+    "and(frankfurt,and(pedralbes,not(sants)))"]
+# Locations of the users of ranked_find, (lat, lon)
+LOCATIONS: List[Tuple[float, float]] = [
+    (41.3870, 2.1700), (41.4036, 2.1744), (41.3809, 2.1228),
+    (41.4145, 2.1527), (41.3755, 2.1492)]
+
+#   ********************
+#   Synthetic city graph
+#   ********************
+
+
+def street_grid(seed: int = SEED) -> city.OsmnxGraph:
+    '''
+    Returns an OsmnxGraph (as get_osmnx_graph) with a street grid over
+    Barcelona, built without network: crossings every BLOCK meters moved at
+    random up to JITTER blocks, with some streets missing and some bent (an
+    intersection in the middle, which is contracted by build_city_graph).
+
+    Parameters
+    ----------
+    seed: int
+
+    Returns
+    -------
+    city.OsmnxGraph
+    '''
+    rng: random.Random = random.Random(seed)
+    lat_step: float = BLOCK / geo.EARTH_RADIUS * 180 / np.pi
+    lon_step: float = lat_step / np.cos(np.radians((MIN_LAT + MAX_LAT) / 2))
+    rows: int = int((MAX_LAT - MIN_LAT) / lat_step)
+    cols: int = int((MAX_LON - MIN_LON) / lon_step)
+
+    g: city.OsmnxGraph = nx.MultiDiGraph(crs="epsg:4326")
+    next_id: int = 10**9  # similar to osmids
+
+    def add_node(lon: float, lat: float) -> int:
+        nonlocal next_id
+        next_id += 1
+        g.add_node(next_id, x=lon, y=lat, pos=(lon, lat), street_count=4,
+                   type="street_intersection")
+        return next_id
+
+    crossing: Dict[Tuple[int, int], int] = {
+        (i, j): add_node(
+            MIN_LON + (j + rng.uniform(-JITTER, JITTER)) * lon_step,
+            MIN_LAT + (i + rng.uniform(-JITTER, JITTER)) * lat_step)
+        for i in range(rows) for j in range(cols)}
+    for (i, j), u in crossing.items():
+        for v in (crossing.get((i + 1, j)), crossing.get((i, j + 1))):
+            if v is None or rng.random() < MISSING_STREETS:
+                continue
+            street: List[int] = [u, v]
+            if rng.random() < BENT_STREETS:
+                (x1, y1), (x2, y2) = g.nodes[u]["pos"], g.nodes[v]["pos"]
+                street.insert(1, add_node(
+                    (x1 + x2) / 2 + rng.uniform(-0.1, 0.1) * lon_step,
+                    (y1 + y2) / 2 + rng.uniform(-0.1, 0.1) * lat_step))
+            for a, b in zip(street, street[1:]):
+                g.add_edge(a, b)
+                g.add_edge(b, a)
+
+    # Only the biggest connected part is kept
+    g.remove_nodes_from(set(g) - max(nx.weakly_connected_components(g),
+                                     key=len))
+    edges: List[Tuple[int, int, int]] = list(g.edges)
+    ends: np.ndarray = np.array([g.nodes[u]["pos"] + g.nodes[v]["pos"]
+                                 for u, v, _ in edges])
+    distances: np.ndarray = geo.distance(ends[:, 1], ends[:, 0],
+                                         ends[:, 3], ends[:, 2])
+    for edge, distance in zip(edges, distances.tolist()):
+        g.edges[edge].update(distance=distance,
+                             travel_time=distance/city.WALKING_SPEED,
+                             acc_travel_time=distance/city.WALKING_SPEED,
+                             type="street")
+    return g
+
+
+def random_point(rng: random.Random) -> Tuple[float, float]:
+    '''Returns a random (lat, lon) inside the street grid'''
+    return (rng.uniform(MIN_LAT + 0.005, MAX_LAT - 0.005),
+            rng.uniform(MIN_LON + 0.005, MAX_LON - 0.005))
+
+
+@contextmanager
+def no_tiles() -> Iterator[None]:
+    '''
+    Context manager which makes the maps be rendered over a blank image
+    instead of downloading the tiles
+    '''
+    draw: Callable = metro.TimedMap._draw_base_layer
+    metro.TimedMap._draw_base_layer = lambda self, image: None
+    try:
+        yield
+    finally:
+        metro.TimedMap._draw_base_layer = draw
+
+
+#   ************
+#   Measurements
+#   ************
+
+
+def timings(func: Callable[[], Any], repeat: int = REPEAT) -> List[float]:
+    '''Returns the seconds taken by each of repeat calls of func'''
+    times: List[float] = []
+    for _ in range(repeat):
+        start: float = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def summary(times: List[float], unit: float = 1000) -> Dict[str, float]:
+    '''
+    Returns the percentiles and mean of the times (in seconds), multiplied
+    by unit (milliseconds by default)
+    '''
+    values: np.ndarray = np.array(times) * unit
+    return {"n": len(times), "mean": float(values.mean()),
+            "p50": float(np.percentile(values, 50)),
+            "p90": float(np.percentile(values, 90)),
+            "p99": float(np.percentile(values, 99)),
+            "max": float(values.max())}
+
+
+def run(routes: int = ROUTES, renders: int = RENDERS,
+        repeat: int = REPEAT, strip: bool = STRIP_GRAPH) -> Dict[str, Any]:
+    '''
+    Runs every benchmark and returns the results. Times are in
+    milliseconds, except build times (seconds) and throughputs (per second).
+
+    Parameters
+    ----------
+    routes: int
+        Number of routes of find_path and of find_restaurant_path
+    renders: int
+        Number of routes rendered with plot_path
+    repeat: int
+        Number of times each build is repeated
+    strip: bool
+        Whether to strip the city graph (see city.strip_graph)
+
+    Returns
+    -------
+    Dict[str, Any]
+    '''
+    results: Dict[str, Any] = {}
+    rng: random.Random = random.Random(SEED)
+
+    # Graphs
+    street: city.OsmnxGraph = street_grid()
+    metro_graph: metro.MetroGraph = metro.get_metro_graph()
+    results["get_metro_graph"] = summary(
+        timings(metro.get_metro_graph, repeat), 1)
+    results["build_city_graph"] = summary(
+        timings(lambda: city.build_city_graph(street, metro_graph), repeat),
+        1)
+    g: city.CityGraph = city.build_city_graph(street, metro_graph)
+    if strip:
+        city.strip_graph(g)
+    start: float = time.perf_counter()
+    g.graph["landmarks"] = city.build_landmarks(g)
+    results["build_landmarks"] = {"seconds": time.perf_counter() - start}
+    results["graph"] = {"street_nodes": street.number_of_nodes(),
+                        "nodes": g.number_of_nodes(),
+                        "edges": g.number_of_edges()}
+
+    # Routes, half of them accessible
+    queries: List[Tuple[Tuple[float, float], Tuple[float, float], bool]] = [
+        (random_point(rng), random_point(rng), i % 2 == 1)
+        for i in range(routes)]
+    paths: List[city.Path] = []
+    times: List[float] = []
+    for src, dst, acc in queries:
+        start = time.perf_counter()
+        paths.append(city.find_path(street, g, src, dst, acc))
+        times.append(time.perf_counter() - start)
+    results["find_path"] = summary(times)
+
+    # Images of the first routes
+    times = []
+    with no_tiles(), tempfile.TemporaryDirectory() as folder:
+        filename: str = os.path.join(folder, "path.png")
+        for (src, dst, _), path in list(zip(queries, paths))[:renders]:
+            start = time.perf_counter()
+            city.plot_path(city.route_summary(g, path, src, dst), filename)
+            times.append(time.perf_counter() - start)
+    results["plot_path"] = summary(times)
+
+    # Restaurants
+    start = time.perf_counter()
+    rsts: restaurants.Restaurants = restaurants.read()
+    results["read_restaurants"] = {"seconds": time.perf_counter() - start,
+                                   "restaurants": len(rsts)}
+    index: restaurants.RestaurantIndex = restaurants.build_index(rsts)
+    for name, find in (
+            ("find", lambda q, _: restaurants.find(q, rsts)),
+            ("ranked_find", lambda q, loc: restaurants.ranked_find(
+                q, index, loc))):
+        times = []
+        for query in FIND_QUERIES:
+            for loc in LOCATIONS:
+                start = time.perf_counter()
+                find(query, loc)
+                times.append(time.perf_counter() - start)
+        results[name] = summary(times)
+        results[name]["per_second"] = len(times) / sum(times)
+
+    # Routes to restaurants, over the metro links and the access table
+    start = time.perf_counter()
+    links: city.MetroLinks = city.build_metro_links(g)
+    results["build_metro_links"] = {"seconds": time.perf_counter() - start}
+    start = time.perf_counter()
+    table: city.AccessTable = city.build_access_table(
+        g, city.snap_restaurants(street, g, rsts))
+    results["build_access_table"] = {"seconds": time.perf_counter() - start}
+    times = []
+    for src, _, acc in queries:
+        rst: restaurants.Restaurant = rng.choice(rsts)
+        start = time.perf_counter()
+        city.find_restaurant_path(street, g, links, table, src, rst.coords,
+                                  rst.id, acc)
+        times.append(time.perf_counter() - start)
+    results["find_restaurant_path"] = summary(times)
+    return results
+
+
+def metadata() -> Dict[str, Any]:
+    '''Returns the version of the code and the machine of the results'''
+    try:
+        commit: Optional[str] = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except Exception:
+        commit = None
+    return {"date": datetime.now().isoformat(timespec="seconds"),
+            "commit": commit, "python": platform.python_version(),
+            "machine": platform.machine(), "seed": SEED}
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any]) -> None:
+    '''
+    Prints every measurement of two results (as saved by main) and the
+    ratio new/old
+    '''
+    for bench, values in new["results"].items():
+        for key, value in values.items():
+            before: Any = old["results"].get(bench, {}).get(key)
+            if isinstance(before, (int, float)) and before:
+                print(f"{bench + '.' + key:<28} {before:>12.3f} "
+                      f"{value:>12.3f} {value / before:>7.2f}x")
+
+
+def main() -> None:
+    '''
+    Runs the benchmarks, saves the results in JSON and compares them with
+    previous results if asked
+    '''
+    parser = argparse.ArgumentParser(description=(
+        "Offline benchmarks of routing, search and rendering"))
+    parser.add_argument("-o", "--output", default=RESULTS_FILE,
+                        help="JSON file where the results are saved")
+    parser.add_argument("-c", "--compare",
+                        help="JSON file with previous results")
+    parser.add_argument("--quick", action="store_true",
+                        help="fewer routes, renders and repetitions")
+    parser.add_argument("--no-strip", action="store_true",
+                        help="keep every attribute of the city graph")
+    args = parser.parse_args()
+
+    if args.quick:
+        results: Dict[str, Any] = run(routes=ROUTES // 5,
+                                      renders=RENDERS // 5, repeat=1,
+                                      strip=not args.no_strip)
+    else:
+        results = run(strip=not args.no_strip)
+    data: Dict[str, Any] = {"meta": metadata(), "results": results}
+    with open(args.output, "w") as file:
+        json.dump(data, file, indent=2)
+    print(json.dumps(results, indent=2))
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), data)
+
+
+if __name__ == "__main__":
+    main()
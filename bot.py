@@ -1,19 +1,31 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from contextlib import contextmanager
 import os
 import time
-from telegram import Update
+from telegram import Update, InlineQueryResultArticle, \
+    InputTextMessageContent
 from telegram.ext import CommandHandler, Filters, MessageHandler,\
-    CallbackContext, Updater
+    CallbackContext, Updater, InlineQueryHandler
 import logging
 import random
-from typing import Optional, List, Tuple, Callable
+import threading
+import functools
+import cProfile
+import pstats
+import glob
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Tuple, Callable, Dict, Union, Set, \
+    Iterator
 from typing_extensions import TypeAlias
-from haversine import haversine
 
 # We import the base modules
 import metro
 import city
 import restaurants
+import metrics
+from constants import STRIP_GRAPH
 
 
 # We define necessary TypeAlias
@@ -22,6 +34,38 @@ Restaurants: TypeAlias = restaurants.Restaurants
 Coord: TypeAlias = Tuple[float, float]
 NodeID: TypeAlias = int
 Path: TypeAlias = List[NodeID]
+# (source node, restaurant id, accessibility) of a /guide request
+GuideKey: TypeAlias = Tuple[NodeID, int, bool]
+
+RELOAD_INTERVAL: float = 60  # seconds between checks of the restaurants file
+# Speculation: after /find, the routes to the first SPECULATE_RESULTS
+# restaurants are computed in the background, using at most SPECULATION_CPU
+# seconds of CPU per second (with bursts of up to SPECULATION_BURST seconds)
+SPECULATE_RESULTS: int = 3
+SPECULATION_CPU: float = 0.25
+SPECULATION_BURST: float = 5
+SPECULATION_CACHE: int = 256  # guides kept
+PRERENDER: bool = False  # whether the images are also rendered in advance
+# Admission control of the expensive commands: (requests running at once,
+# requests waiting), waiting at most QUEUE_TIMEOUT seconds
+ADMISSION: Dict[str, Tuple[int, int]] = {'guide': (2, 6), 'plot_metro': (1, 2)}
+QUEUE_TIMEOUT: float = 20
+# Worker threads besides the ones of the admitted requests
+SPARE_WORKERS: int = 4
+# Each user can make USER_RATE expensive requests per second, with bursts of
+# USER_BURST requests
+USER_RATE: float = 0.1
+USER_BURST: float = 3
+# Profiling (opt-in): one command in PROFILE_EVERY is run under cProfile (0
+# for none), besides the ones requested by an admin with /profile. The last
+# PROFILE_KEEP profiles are kept in PROFILE_DIR, with a summary of the
+# PROFILE_TOP functions with most cumulative time of each one, and of each
+# command.
+PROFILE_EVERY: int = 0
+PROFILE_DIR: str = "profiles"
+PROFILE_KEEP: int = 50
+PROFILE_TOP: int = 25
+ADMINS_FILE: str = "admins.txt"  # Telegram user ids of the admins
 
 
 @ dataclass
@@ -35,11 +79,161 @@ class User:
     current_search: Optional[restaurants.Restaurants]
     name: str
     accessibility: bool = False
+    speculation: Optional[threading.Event]
+        Set to cancel the routes being speculated for the user
+    rate: Budget
+        Expensive requests that the user can make (see admitted)
+    profile: bool
+        Whether the next command of the user is profiled (see /profile)
     '''
     location: Optional[Coord]
     current_search: Optional[restaurants.Restaurants]
     name: str
     accessibility: bool = False
+    speculation: Optional[threading.Event] = None
+    rate: 'Budget' = field(default_factory=lambda: Budget(
+        USER_RATE, USER_BURST, USER_BURST, time.monotonic()))
+    profile: bool = False
+
+
+@ dataclass
+class RestaurantData:
+    '''
+    Class to store the restaurants and everything derived from them. When
+    the restaurants are reloaded a new RestaurantData replaces the old one in
+    a single assignment, so each command sees a consistent version.
+
+    Attributes
+    ----------
+    index: restaurants.RestaurantIndex
+    access: city.AccessTable
+    completions: restaurants.Completions
+    mtime: float
+        Modification time of the restaurants file when it was read
+    '''
+    index: restaurants.RestaurantIndex
+    access: city.AccessTable
+    completions: restaurants.Completions
+    mtime: float
+
+
+@ dataclass
+class Guide:
+    '''
+    Class to store the answer to a /guide request, which can be sent to
+    several users. Its instructions are written when it is sent, since
+    they tell the time of each step.
+
+    Attributes
+    ----------
+    path: Path
+    route: city.RouteSummary
+    image: bytes
+        Image of the path in PNG format
+    '''
+    path: Path
+    route: city.RouteSummary
+    image: bytes
+
+
+@ dataclass
+class Flight:
+    '''
+    Class to store a Guide which is being computed, so that identical
+    requests made meanwhile wait for it instead of computing it again
+
+    Attributes
+    ----------
+    done: threading.Event
+        Set when the computation has finished
+    guide: Optional[Guide]
+    error: Optional[Exception]
+        Exception raised by the computation, if any
+    '''
+    done: threading.Event
+    guide: Optional[Guide] = None
+    error: Optional[Exception] = None
+
+
+@ dataclass
+class Budget:
+    '''
+    Class to limit the use of something over time (a token bucket): the CPU
+    time used by speculation and the requests of each user
+
+    Attributes
+    ----------
+    rate: float
+        Tokens earned per second
+    burst: float
+        Maximum tokens that can be saved
+    tokens: float
+        Tokens available
+    last: float
+        Time (time.monotonic) of the last update of tokens
+    '''
+    rate: float
+    burst: float
+    tokens: float
+    last: float
+
+
+@ dataclass
+class Admission:
+    '''
+    Class to control the requests of an expensive command: at most limit
+    run at once and at most queue wait for their turn, the rest are rejected
+
+    Attributes
+    ----------
+    limit: int
+    queue: int
+    running: int
+    waiting: int
+    rejected: int
+        Requests rejected because the queue was full or they waited too long
+    limited: int
+        Requests rejected because the user made too many
+    turn: threading.Condition
+        Notified when a request finishes
+    '''
+    limit: int
+    queue: int
+    running: int = 0
+    waiting: int = 0
+    rejected: int = 0
+    limited: int = 0
+    turn: threading.Condition = field(default_factory=threading.Condition)
+
+
+class Busy(Exception):
+    '''
+    Raised when a request gets no turn of an Admission (see turn)
+    '''
+
+
+# Guides being computed, by request
+flights: Dict[GuideKey, Flight] = {}
+flights_lock: threading.Lock = threading.Lock()
+
+# Guides (or only their paths, without PRERENDER) computed in advance, in
+# least recently used order
+speculated: 'OrderedDict[GuideKey, Union[Guide, Path]]' = OrderedDict()
+speculated_lock: threading.Lock = threading.Lock()
+# A single thread, so speculation never uses more than one core (and at
+# most SPECULATION_CPU on average, see budget)
+speculator: ThreadPoolExecutor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix='speculator')
+budget: Budget = Budget(SPECULATION_CPU, SPECULATION_BURST,
+                        SPECULATION_BURST, time.monotonic())
+
+# cProfile can only profile one command at a time
+profiler_lock: threading.Lock = threading.Lock()
+admins: Set[int] = set()
+
+admissions: Dict[str, Admission] = {
+    command: Admission(limit, queue)
+    for command, (limit, queue) in ADMISSION.items()}
 
 
 class Exception_messages:
@@ -47,6 +241,44 @@ class Exception_messages:
     Class to handle all the exception messages
     '''
 
+    @ staticmethod
+    def busy(update: Update, context: CallbackContext,
+             command: str) -> None:
+        '''
+        Exception message for when there are too many requests of a command
+
+        Parameters
+        ----------
+        update : Update
+        context : CallbackContext
+        command : str
+            The name of the command that raised the exception
+        '''
+        assert update.effective_chat is not None
+        context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=(f"Ara mateix hi ha massa peticions de /{command} 😵\n"
+                  f"Torna-ho a provar d'aquí a una estona, si us plau"))
+
+    @ staticmethod
+    def too_many_requests(update: Update, context: CallbackContext,
+                          command: str) -> None:
+        '''
+        Exception message for when a user makes too many expensive requests
+
+        Parameters
+        ----------
+        update : Update
+        context : CallbackContext
+        command : str
+            The name of the command that raised the exception
+        '''
+        assert update.effective_chat is not None
+        context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=(f"Has fet massa peticions seguides 🐢\nEspera una mica "
+                  f"abans de tornar a fer servir /{command}"))
+
     @ staticmethod
     def unexisting_search(update: Update, context: CallbackContext) -> None:
         '''
@@ -176,13 +408,19 @@ def exception_handler(func: Callable):
         The function we will handle the exceptions from
     '''
 
+    @ functools.wraps(func)
     def custom_exception(*args):
         update: Update = args[0]
         context: CallbackContext = args[1]
         try:
             if "user" not in context.user_data:
                 register_user(update, context)
-            func(*args)
+            # The whole command is a stage with its name
+            with metrics.timed(func.__name__):
+                if should_profile(context.user_data['user']):
+                    profiled(func, *args)
+                else:
+                    func(*args)
         except Exception as e:
             print('Exception:', e)
             Exception_messages.general_error(update, context)
@@ -190,6 +428,192 @@ def exception_handler(func: Callable):
     return custom_exception
 
 
+def should_profile(user: User) -> bool:
+    '''
+    Returns whether a command of the user has to be profiled: if an admin
+    asked for it or, if sampling is enabled, one in PROFILE_EVERY
+    '''
+    if user.profile:
+        user.profile = False
+        return True
+    return PROFILE_EVERY > 0 and random.randrange(PROFILE_EVERY) == 0
+
+
+def profiled(func: Callable, *args) -> None:
+    '''
+    Runs func(*args) under cProfile and saves the profile (see
+    save_profile). If another command is being profiled it is run normally.
+    '''
+    if not profiler_lock.acquire(blocking=False):
+        func(*args)
+        return
+    profiler: cProfile.Profile = cProfile.Profile()
+    try:
+        profiler.runcall(func, *args)
+    finally:
+        try:
+            save_profile(profiler, func.__name__)
+        except Exception as e:
+            print('Could not save profile:', e)
+        profiler_lock.release()
+
+
+def save_profile(profiler: cProfile.Profile, command: str) -> None:
+    '''
+    Saves the profile of a command in PROFILE_DIR with a text summary, and
+    updates the summary of all the profiles of the command. Only the last
+    PROFILE_KEEP profiles are kept.
+    '''
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name: str = os.path.join(
+        PROFILE_DIR,
+        f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{command}")
+    profiler.dump_stats(name + ".prof")
+    with open(name + ".txt", 'w') as summary:
+        pstats.Stats(profiler, stream=summary).sort_stats(
+            'cumulative').print_stats(PROFILE_TOP)
+
+    # The names start with the date, so the oldest come first
+    profiles: List[str] = sorted(glob.glob(os.path.join(PROFILE_DIR,
+                                                        "*.prof")))
+    for old in profiles[:-PROFILE_KEEP]:
+        os.remove(old)
+        if os.path.exists(old[:-len(".prof")] + ".txt"):
+            os.remove(old[:-len(".prof")] + ".txt")
+    same: List[str] = [p for p in profiles[-PROFILE_KEEP:]
+                       if p.endswith(f"-{command}.prof")]
+    with open(os.path.join(PROFILE_DIR, f"summary-{command}.txt"),
+              'w') as summary:
+        summary.write(f"/{command}: {len(same)} profiles\n")
+        pstats.Stats(*same, stream=summary).sort_stats(
+            'cumulative').print_stats(PROFILE_TOP)
+
+
+def admitted(command: str, whole: bool = True,
+             valid: Optional[Callable[[Update, CallbackContext], bool]] = None
+             ) -> Callable:
+    '''
+    Decorator that applies the admission control of command (see Admission)
+    to a bot function. It must be used inside exception_handler, since
+    the user must be registered.
+
+    Parameters
+    ----------
+    command : str
+        The name of the command, a key of ADMISSION
+    whole : bool
+        Whether the whole function takes a turn to run. Otherwise the
+        function takes it (see turn) only for its expensive part, and the
+        requests rejected meanwhile are answered here.
+    valid : Optional[Callable[[Update, CallbackContext], bool]]
+        Checks the arguments of a request, answering the user if they are
+        wrong, before it is admitted. Wrong requests do not count for the
+        rate of the user.
+    '''
+    adm: Admission = admissions[command]
+
+    def decorator(func: Callable) -> Callable:
+        @ functools.wraps(func)
+        def admission_control(update: Update,
+                              context: CallbackContext) -> None:
+            assert context.user_data is not None
+            user: User = context.user_data['user']
+            if valid is not None and not valid(update, context):
+                return
+            reason: Optional[str] = admit(adm, user.rate)
+            try:
+                if reason is None:
+                    if whole:
+                        with turn(adm):
+                            func(update, context)
+                    else:
+                        func(update, context)
+            except Busy:
+                reason = 'busy'
+            if reason == 'rate':
+                Exception_messages.too_many_requests(update, context, command)
+            elif reason == 'busy':
+                print(f"Rejected /{command}: {admission_stats()[command]}")
+                Exception_messages.busy(update, context, command)
+        return admission_control
+    return decorator
+
+
+def admit(adm: Admission, rate: Budget) -> Optional[str]:
+    '''
+    Decides at once whether a request is rejected: returns 'busy' if no
+    more requests can wait for a turn of adm, 'rate' if the user (whose
+    requests are limited by rate) made too many, or None if it is admitted.
+    Only admitted requests take a token of rate.
+    '''
+    with adm.turn:
+        if adm.running >= adm.limit and adm.waiting >= adm.queue:
+            adm.rejected += 1
+            return 'busy'
+        if not take_token(rate):
+            adm.limited += 1
+            return 'rate'
+    return None
+
+
+@ contextmanager
+def turn(adm: Admission) -> Iterator[None]:
+    '''
+    Context manager which waits for a turn to run (at most QUEUE_TIMEOUT
+    seconds) and releases it at the end of its block. Raises Busy if the
+    queue is full or there is no turn in time.
+    '''
+    with adm.turn:
+        if adm.running >= adm.limit:
+            if adm.waiting >= adm.queue:
+                adm.rejected += 1
+                raise Busy()
+            adm.waiting += 1
+            deadline: float = time.monotonic() + QUEUE_TIMEOUT
+            while adm.running >= adm.limit and time.monotonic() < deadline:
+                adm.turn.wait(deadline - time.monotonic())
+            adm.waiting -= 1
+            if adm.running >= adm.limit:
+                adm.rejected += 1
+                raise Busy()
+        adm.running += 1
+    try:
+        yield
+    finally:
+        with adm.turn:
+            adm.running -= 1
+            adm.turn.notify()
+
+
+def admission_stats() -> Dict[str, Dict[str, int]]:
+    '''
+    Returns the requests running and waiting (queue depth) of each command
+    with admission control, and how many have been rejected
+    '''
+    return {command: {'running': adm.running, 'waiting': adm.waiting,
+                      'rejected': adm.rejected, 'limited': adm.limited}
+            for command, adm in admissions.items()}
+
+
+def admission_metrics() -> List[str]:
+    '''
+    Returns admission_stats in Prometheus text format (see metrics)
+    '''
+    lines: List[str] = []
+    stats: Dict[str, Dict[str, int]] = admission_stats()
+    for stat, kind, help_txt in (
+            ('running', 'gauge', 'Requests running'),
+            ('waiting', 'gauge', 'Requests waiting for admission'),
+            ('rejected', 'counter', 'Requests rejected by load'),
+            ('limited', 'counter', 'Requests rejected by the user rate')):
+        name: str = f"{metrics.PREFIX}_admission_{stat}" + \
+            ("_total" if kind == 'counter' else "")
+        lines += [f"# HELP {name} {help_txt}", f"# TYPE {name} {kind}"]
+        lines += [f'{name}{{command="{command}"}} {values[stat]}'
+                  for command, values in stats.items()]
+    return lines
+
+
 def register_user(update: Update, context: CallbackContext) -> None:
     '''
     Registers a new user
@@ -283,12 +707,14 @@ def update_location(update: Update, context: CallbackContext) -> None:
     lat: float = update.message.location.latitude
     lon: float = update.message.location.longitude
     context.user_data['user'].location = (lat, lon)
+    speculate(context.user_data['user'])
     context.bot.send_message(
         chat_id=update.effective_chat.id,
         text='Localització actualitzada 📍')
 
 
 @ exception_handler
+@ admitted('plot_metro')
 def plot_metro(update: Update, context: CallbackContext) -> None:
     '''
     Send metro plot image to the user
@@ -307,26 +733,6 @@ def plot_metro(update: Update, context: CallbackContext) -> None:
     os.remove(file)
 
 
-def sort_rsts(rsts: Restaurants, loc: Coord) -> Restaurants:
-    '''
-    Sorts a list of restaurants by proximity to the user's location
-
-    Parameters
-    ----------
-    rsts : Restaurants
-        Restaurant list to sort
-    loc : Coord
-        User's location
-
-    Returns
-    -------
-    Restaurants
-        A sorted by proximity list of restaurants
-    '''
-    return sorted(rsts, key=lambda rst: haversine(
-        (loc[1], loc[0]), (rst.coords[1], rst.coords[0])))
-
-
 @ exception_handler
 def find(update: Update, context: CallbackContext) -> None:
     '''
@@ -346,19 +752,45 @@ def find(update: Update, context: CallbackContext) -> None:
         return
     print(query)
 
-    search: Restaurants = restaurants.find(query, rest)
     user: User = context.user_data['user']
-    # If we have the location we sort results by distance
-    if user.location is not None:
-        search = sort_rsts(search, user.location)
-    search = search[:12]
+    # If we have the location the results are the closest ones
+    with metrics.timed('search'):
+        search: Restaurants = restaurants.ranked_find(
+            query, rest_data.index, user.location, 12)
     user.current_search = search
+    speculate(user)
     msg: str = "".join([f"{i}. {res.name}\n" for i, res in enumerate(search)])
-    context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text=msg if msg else
-        f"no s'han pogut trobar restaurants amb la cerca: {query} 🤷‍♂️"
-    )
+    with metrics.timed('send'):
+        context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=msg if msg else
+            f"no s'han pogut trobar restaurants amb la cerca: {query} 🤷‍♂️"
+        )
+
+
+def suggest(update: Update, context: CallbackContext) -> None:
+    '''
+    Answers an inline query with the names of restaurants, roads and
+    neighbourhoods which can complete it. Choosing one sends /find with it,
+    quoted so that its commas and parentheses are not operators.
+
+    Parameters
+    ----------
+    update : Update
+    context : CallbackContext
+    '''
+    # Inline queries have no chat to send error messages to, so they are not
+    # handled by exception_handler
+    assert update.inline_query is not None
+    icons = {'restaurant': '🍽', 'road': '📍', 'neighbourhood': '🏘'}
+    names: List[Tuple[str, str]] = restaurants.complete(
+        update.inline_query.query, rest_data.completions)
+    update.inline_query.answer([
+        InlineQueryResultArticle(
+            id=str(i), title=f"{icons[kind]} {name}",
+            input_message_content=InputTextMessageContent(
+                '/find "{}"'.format(name.replace('"', ''))))
+        for i, (name, kind) in enumerate(names)])
 
 
 @ exception_handler
@@ -375,6 +807,7 @@ def accessibility(update: Update, context: CallbackContext) -> None:
     assert not(context.user_data is None or update.effective_chat is None)
     old_acc: bool = context.user_data['user'].accessibility
     context.user_data['user'].accessibility = not old_acc
+    speculate(context.user_data['user'])
     if old_acc:
         print("Accessibility disabled")
         message: str = "Accessiblitat desactivada ❌"
@@ -418,20 +851,21 @@ def info(update: Update, context: CallbackContext) -> None:
     message: str
     photo_url: Optional[str]
     message, photo_url = restaurants.get_info_message(restaurant)
-    if photo_url is not None:
-        context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=photo_url, caption=message)
-    else:
-        context.bot.send_message(
-            chat_id=update.effective_chat.id, text=message)
+    with metrics.timed('send'):
+        if photo_url is not None:
+            context.bot.send_photo(
+                chat_id=update.effective_chat.id,
+                photo=photo_url, caption=message)
+        else:
+            context.bot.send_message(
+                chat_id=update.effective_chat.id, text=message)
 
 
-@ exception_handler
-def guide(update: Update, context: CallbackContext) -> None:
+def valid_guide(update: Update, context: CallbackContext) -> bool:
     '''
-    Guides the user from its location to a restaurant by sending an image of
-    the path, and a resumed set of instructions in a text message
+    Returns whether a /guide request can be answered: the user has a
+    location and has chosen a result of their last search. Otherwise the
+    user is told what is wrong.
 
     Parameters
     ----------
@@ -443,40 +877,243 @@ def guide(update: Update, context: CallbackContext) -> None:
     user: User = context.user_data['user']
     if not context.args:
         Exception_messages.missing_arguments(update, context, 'guide')
-        return
+        return False
     if not user.current_search:
         Exception_messages.unexisting_search(update, context)
-        return
+        return False
     if user.location is None:
         Exception_messages.missing_location(update, context, 'guide')
-        return
+        return False
     if not context.args[0].isdigit():
         Exception_messages.invalid_type(update, context, 'enters')
-        return
+        return False
     if not(0 <= int(context.args[0]) < len(user.current_search)):
         Exception_messages.invalid_range(
             update, context, 'guide', (0, len(user.current_search)-1))
-        return
+        return False
+    return True
 
-    t1: float = time.time()
-    filename: str = f"{random.randint(1000000, 9999999)}.png"
+
+@ exception_handler
+@ admitted('guide', whole=False, valid=valid_guide)
+def guide(update: Update, context: CallbackContext) -> None:
+    '''
+    Guides the user from its location to a restaurant by sending an image of
+    the path, and a resumed set of instructions in a text message. The
+    request has been checked by valid_guide.
+
+    Parameters
+    ----------
+    update : Update
+    context : CallbackContext
+    '''
+    assert not(context.user_data is None or context.args is None or
+               update.effective_chat is None)
+    user: User = context.user_data['user']
+    assert user.location is not None and user.current_search
     src: Coord = user.location
-    dst: Coord = user.current_search[int(context.args[0])].coords
+    rst: Restaurant = user.current_search[int(context.args[0])]
+    acc: bool = user.accessibility
+    with metrics.timed('snap'):
+        src_node: NodeID = city.nearest_node(city_osmnx, city_graph, src)
+    key: GuideKey = (src_node, rst.id, acc)
+    result: Guide = single_flight(key, lambda: cached_guide(key, src, rst))
+    with metrics.timed('text'):
+        text: str = (f"{city.path_txt(result.route)} | Ja has arribat"
+                     f"a {rst.name}")
+    with metrics.timed('send'):
+        context.bot.send_photo(
+            chat_id=update.effective_chat.id, photo=result.image)
+        context.bot.send_message(
+            chat_id=update.effective_chat.id, text=text)
+
+
+def make_guide(src: Coord, src_node: NodeID, rst: Restaurant,
+               accessibility: bool, path: Optional[Path] = None) -> Guide:
+    '''
+    Computes the path from src (whose node is src_node) to a restaurant,
+    unless it is given, its summary and its image
+    '''
+    if path is None:
+        with metrics.timed('route'):
+            path = city.find_restaurant_path(
+                city_osmnx, city_graph, metro_links, rest_data.access, src,
+                rst.coords, rst.id, accessibility, src_node)
+    route: city.RouteSummary = city.route_summary(city_graph, path, src,
+                                                  rst.coords)
+    filename: str = f"{random.randint(1000000, 9999999)}.png"
+    # Includes the 'tiles' stage
+    with metrics.timed('render'):
+        city.plot_path(route, filename)
+        with open(filename, 'rb') as file:
+            image: bytes = file.read()
+        os.remove(filename)
+    return Guide(path, route, image)
+
+
+def single_flight(key: GuideKey, compute: Callable[[], Guide]) -> Guide:
+    '''
+    Returns compute(), unless an identical request (same key) is already
+    being computed, in which case it waits for it and returns its Guide (or
+    raises its exception).
+    '''
+    with flights_lock:
+        flight: Optional[Flight] = flights.get(key)
+        leader: bool = flight is None
+        if flight is None:
+            flight = flights[key] = Flight(threading.Event())
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        assert flight.guide is not None
+        return flight.guide
+    try:
+        flight.guide = compute()
+        return flight.guide
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with flights_lock:
+            del flights[key]
+        flight.done.set()
+
+
+def cached_guide(key: GuideKey, src: Coord, rst: Restaurant) -> Guide:
+    '''
+    Returns the Guide of a request (see GuideKey) from src to rst, using
+    what has been speculated for it if possible. Computing it takes a turn
+    of the admission control of /guide (see turn).
+    '''
+    with speculated_lock:
+        cached: Optional[Union[Guide, Path]] = speculated.get(key)
+        if cached is not None:
+            speculated.move_to_end(key)
+    if isinstance(cached, Guide):
+        return cached
+    # Only the computation takes a turn, not the requests waiting for it
+    with turn(admissions['guide']):
+        return make_guide(src, key[0], rst, key[2], cached)
+
+
+def speculate(user: User) -> None:
+    '''
+    Cancels the routes being speculated for the user, and starts
+    speculating the routes to the first SPECULATE_RESULTS restaurants of
+    their current search, if they have a location.
+    '''
+    if user.speculation is not None:
+        user.speculation.set()
+        user.speculation = None
+    if user.location is None or not user.current_search:
+        return
+    user.speculation = threading.Event()
+    speculator.submit(speculate_routes, user.location,
+                      user.current_search[:SPECULATE_RESULTS],
+                      user.accessibility, user.speculation)
+
+
+def speculate_routes(src: Coord, rsts: Restaurants, accessibility: bool,
+                     cancelled: threading.Event) -> None:
+    '''
+    Computes the paths from src to every restaurant of rsts with a single
+    search (and their images, if PRERENDER) and saves them in speculated.
+    It stops when cancelled is set, even during the search, and waits while
+    the budget is exhausted. The paths are only saved if the restaurants
+    have not been reloaded meanwhile.
+
+    Parameters
+    ----------
+    src: Coord
+    rsts: Restaurants
+    accessibility: bool
+    cancelled: threading.Event
+    '''
+    while not cancelled.is_set() and not charge_budget(0):
+        cancelled.wait(max(-budget.tokens / budget.rate, 0.1))
+    if cancelled.is_set():
+        return
+    start: float = time.thread_time()
+    data: RestaurantData = rest_data
+    try:
+        with metrics.timed('speculate'):
+            src_node: NodeID = city.nearest_node(city_osmnx, city_graph, src)
+            with speculated_lock:
+                rsts = [rst for rst in rsts if
+                        (src_node, rst.id, accessibility) not in speculated]
+            paths: List[Path] = city.find_restaurant_paths(
+                city_osmnx, city_graph, metro_links, data.access, src,
+                [(rst.coords, rst.id) for rst in rsts], accessibility,
+                src_node, cancelled.is_set)
+        for rst, path in zip(rsts, paths):
+            if cancelled.is_set():
+                return
+            result: Union[Guide, Path] = make_guide(
+                src, src_node, rst, accessibility, path) if PRERENDER else path
+            with speculated_lock:
+                # reload_restaurants clears speculated after replacing
+                # rest_data, so paths of the old data are not saved later
+                if rest_data is not data:
+                    return
+                speculated[src_node, rst.id, accessibility] = result
+                while len(speculated) > SPECULATION_CACHE:
+                    speculated.popitem(last=False)
+    except Exception as e:
+        print('Could not speculate routes:', e)
+    finally:
+        charge_budget(time.thread_time() - start)
+
+
+def charge_budget(seconds: float) -> bool:
+    '''
+    Subtracts the CPU seconds used by speculation from the budget, and
+    returns whether some are left. Only the speculator thread uses it.
+    '''
+    refill(budget)
+    budget.tokens -= seconds
+    return budget.tokens > 0
 
-    path: city.Path = city.find_path(
-        city_osmnx, city_graph, src, dst, user.accessibility)
-    city.plot_path(city_graph, path, filename, src, dst)
-    context.bot.send_photo(
-        chat_id=update.effective_chat.id,
-        photo=open(filename, 'rb'))
-    os.remove(filename)
 
+def take_token(bucket: Budget) -> bool:
+    '''
+    Takes a token from bucket if there is one, and returns whether it did
+    '''
+    refill(bucket)
+    if bucket.tokens < 1:
+        return False
+    bucket.tokens -= 1
+    return True
+
+
+def refill(bucket: Budget) -> None:
+    '''Adds the tokens earned since the last update of bucket'''
+    now: float = time.monotonic()
+    bucket.tokens = min(bucket.burst,
+                        bucket.tokens + (now - bucket.last) * bucket.rate)
+    bucket.last = now
+
+
+@ exception_handler
+def profile(update: Update, context: CallbackContext) -> None:
+    '''
+    Makes the next command of an admin run under cProfile (see profiled).
+    For other users it is an unknown command.
+
+    Parameters
+    ----------
+    update : Update
+    context : CallbackContext
+    '''
+    assert not(context.user_data is None or update.effective_chat is None or
+               update.effective_user is None)
+    if update.effective_user.id not in admins:
+        help(update, context)
+        return
+    context.user_data['user'].profile = True
     context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text=(f"{city.path_txt(city_graph, path, src, dst)} | Ja has arribat"
-              f"a {user.current_search[int(context.args[0])].name}"))
-
-    print(f"Path sent in: {time.time()-t1}s")
+        text=f"La propera comanda es desarà a {PROFILE_DIR}/ 🔬")
 
 
 @ exception_handler
@@ -485,17 +1122,58 @@ def default_location(update: Update, context: CallbackContext) -> None:
     assert not(context.user_data is None or context.user_data['user']
                is None or update.effective_chat is None)
     context.user_data['user'].location = (41.388492, 2.113043)
+    speculate(context.user_data['user'])
     context.bot.send_message(
         chat_id=update.effective_chat.id, text="Default ubication set: UPC")
 
 
+def reload_restaurants(context: CallbackContext) -> None:
+    '''
+    Job which checks whether the restaurants file has changed and, if so,
+    reloads it. Only the restaurants which have been added, removed or
+    changed are updated in the search index, the access table and the
+    completions, and then the new version replaces the old one.
+
+    Parameters
+    ----------
+    context : CallbackContext
+    '''
+    global rest_data
+    data: RestaurantData = rest_data
+    try:
+        mtime: float = os.path.getmtime(restaurants.RESTAURANT_FILE)
+        if mtime == data.mtime:
+            return
+        rsts: Restaurants = restaurants.read()
+        added, removed, changed = restaurants.diff(data.index, rsts)
+        index: restaurants.RestaurantIndex = restaurants.update_index(
+            data.index, added, removed, changed)
+        access: city.AccessTable = city.update_access_table(
+            city_osmnx, city_graph, data.access, added + changed, removed)
+        completions: restaurants.Completions = \
+            restaurants.update_completions(data.completions, data.index,
+                                           added, removed, changed)
+        rest_data = RestaurantData(index, access, completions, mtime)
+        with speculated_lock:
+            speculated.clear()
+        print(f"Restaurants reloaded: {len(added)} added, {len(removed)} "
+              f"removed, {len(changed)} changed")
+    except Exception as e:
+        # It will be tried again in the next check
+        print('Could not reload restaurants:', e)
+
+
 def main():
     '''
     Main function that turns on the bot
     '''
 
     # crea objectes per treballar amb Telegram
-    updater = Updater(token=TOKEN, use_context=True)
+    # Admitted requests (running or waiting) take at most the sum of their
+    # limits and queues, the spare workers answer the rest at once
+    workers: int = sum(limit + queue for limit, queue in
+                       ADMISSION.values()) + SPARE_WORKERS
+    updater = Updater(token=TOKEN, use_context=True, workers=workers)
     dispatcher = updater.dispatcher
     print(f"{'-'*13}\nBot is active\n{'-'*13}")
 
@@ -503,13 +1181,27 @@ def main():
     dispatcher.add_handler(CommandHandler('help', help))
     dispatcher.add_handler(CommandHandler('author', author))
     dispatcher.add_handler(MessageHandler(Filters.location, update_location))
-    dispatcher.add_handler(CommandHandler('plot_metro', plot_metro))
+    dispatcher.add_handler(CommandHandler('plot_metro', plot_metro,
+                                          run_async=True))
     dispatcher.add_handler(CommandHandler('find', find))
     dispatcher.add_handler(CommandHandler('info', info))
-    dispatcher.add_handler(CommandHandler('guide', guide))
+    # Guides are computed in the dispatcher's worker threads, so identical
+    # requests can share their computation (see single_flight). Requests
+    # waiting for admission, or for an identical request, also take a worker.
+    dispatcher.add_handler(CommandHandler('guide', guide, run_async=True))
     dispatcher.add_handler(CommandHandler('accessibility', accessibility))
     dispatcher.add_handler(CommandHandler('default', default_location))
+    dispatcher.add_handler(CommandHandler('profile', profile))
     dispatcher.add_handler(MessageHandler(Filters.command, help))
+    dispatcher.add_handler(InlineQueryHandler(suggest))
+
+    # Latencies and admission control at http://127.0.0.1:METRICS_PORT
+    metrics.add_collector(admission_metrics)
+    metrics.serve()
+
+    # Reload the restaurants when their file changes
+    updater.job_queue.run_repeating(reload_restaurants,
+                                    interval=RELOAD_INTERVAL)
 
     # engega el bot
     updater.start_polling()
@@ -523,25 +1215,43 @@ if __name__ == "__main__":
         raise ValueError(
             "file 'token.txt' does not exist in the current directory")
     TOKEN = open('token.txt').read().strip()
+    if os.path.exists(ADMINS_FILE):
+        admins = {int(line) for line in open(ADMINS_FILE) if line.strip()}
 
     #   **************
     #   INITIALIZATION
     #   **************
     print(f"{'*'*16}\nInitializing bot\n{'*'*16}")
-    t1 = time.time()
-    metro_graph: metro.MetroGraph = metro.get_metro_graph()
-    print('get_metro_graph time:', time.time() - t1)
-    t2 = time.time()
-    city_osmnx = city.get_osmnx_graph()
-    print('get_osmnx_graph time:', time.time() - t2)
-    t2 = time.time()
-    city_graph: city.CityGraph = city.build_city_graph(city_osmnx,
-                                                       metro_graph)
-    print('build_city_graph time:', time.time() - t2)
-    t2 = time.time()
-    rest: restaurants.Restaurants = restaurants.read()
-    print('restaurants.read time:', time.time() - t2)
-    print('Total initialization time:', time.time() - t1)
+    # Each step is logged as a stage (see metrics)
+    with metrics.timed('init'):
+        with metrics.timed('init_metro_graph'):
+            metro_graph: metro.MetroGraph = metro.get_metro_graph()
+        with metrics.timed('init_osmnx_graph'):
+            city_osmnx = city.get_osmnx_graph()
+        with metrics.timed('init_city_graph'):
+            city_graph: city.CityGraph = city.build_city_graph(city_osmnx,
+                                                               metro_graph)
+        if STRIP_GRAPH:
+            before: Tuple[float, float] = city.graph_bytes(city_graph)
+            city.strip_graph(city_graph)
+            after: Tuple[float, float] = city.graph_bytes(city_graph)
+            print('bytes per node: %.0f -> %.0f, bytes per edge: %.0f -> %.0f'
+                  % (before[0], after[0], before[1], after[1]))
+        with metrics.timed('init_landmarks'):
+            city.get_landmarks(city_graph)
+        with metrics.timed('init_restaurants'):
+            rest_index: restaurants.RestaurantIndex = restaurants.read_index()
+            rest: restaurants.Restaurants = rest_index.rsts
+        with metrics.timed('init_metro_links'):
+            metro_links: city.MetroLinks = city.build_metro_links(city_graph)
+        with metrics.timed('init_access_table'):
+            rest_nodes: city.RestaurantNodes = city.snap_restaurants(
+                city_osmnx, city_graph, rest)
+            rest_access: city.AccessTable = city.build_access_table(
+                city_graph, rest_nodes)
+            rest_data: RestaurantData = RestaurantData(
+                rest_index, rest_access, restaurants.build_completions(rest),
+                os.path.getmtime(restaurants.RESTAURANT_FILE))
     print(f"{'*'*54}\n")
 
     help_txt = {}
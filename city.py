@@ -1,19 +1,29 @@
 import osmnx as ox
 import networkx as nx
 from staticmap import StaticMap, CircleMarker, Line
+from PIL import ImageDraw
+import numpy as np
 import matplotlib.pyplot as plt
 from typing_extensions import TypeAlias
-from typing import IO, List, Tuple, Dict
+from typing import IO, List, Tuple, Dict, Optional, Iterator, Union, \
+    Callable, Any, Iterable, cast
+from dataclasses import dataclass, field
 import pickle as pkl
 import os.path
 from datetime import datetime, timedelta
-from haversine import haversine
+from math import log, tan, cos, pi, radians
+import heapq
+import hashlib
+import sys
 
 # We import the required module
 import metro
+import ids
+import geo
 
 # Constants
 PICKLE_FILENAME: str = "barcelona.grf"
+LANDMARKS_FILENAME: str = "barcelona_landmarks.npz"
 PADDING: int = 10
 WALKING_SPEED: float = metro.WALKING_SPEED
 SIZE_X: int = metro.SIZE_X
@@ -21,6 +31,27 @@ SIZE_Y: int = metro.SIZE_Y
 TRANSFER_COLOR: str = 'orange'
 STREET_COLOR: str = 'black'
 ACCESS_COLOR: str = 'grey'
+LEG_KINDS: Dict[str, str] = {'street': 'walk', 'Street': 'walk',
+                             'access': 'walk', 'line': 'metro',
+                             'transfer': 'transfer'}
+TILE_SIZE: int = 256
+MAX_ZOOM: int = 17
+PATH_WIDTH: int = 6
+SIMPLIFY_TOLERANCE: float = 0.5  # pixels in the rendered image
+EDGE_WIDTH: int = 2
+NODE_RADIUS: int = 2
+NODE_LOD_PX: float = 2 * NODE_RADIUS
+WALK_TYPES: Tuple[str, str] = ('street', 'Street')
+METRO_TYPES: Tuple[str, str] = ('access', 'station')
+ACCESS_RADIUS: float = 1500  # meters
+SHORT_TRIP: float = 1000  # meters, straight line
+BBOX_MARGIN: float = 300  # meters
+METERS_PER_DEGREE: float = 111000  # a bit less than a degree of latitude
+N_LANDMARKS: int = 16
+STREET_ATTRS: Tuple[str, ...] = ('type', 'distance', 'travel_time',
+                                 'orientation', 'geometry')
+ALT_SLACK: float = 0.01  # seconds, covers the float32 rounding of the tables
+CANCEL_CHECK: int = 256  # nodes searched between checks of cancellation
 
 
 # We define necessary TypeAlias
@@ -28,8 +59,195 @@ CityGraph: TypeAlias = nx.Graph
 OsmnxGraph: TypeAlias = nx.MultiDiGraph
 Coord: TypeAlias = Tuple[float, float]
 MetroGraph: TypeAlias = nx.Graph
-NodeID: TypeAlias = int
+NodeID: TypeAlias = ids.NodeID
 Path: TypeAlias = List[NodeID]
+Polyline: TypeAlias = Tuple[List[Coord], str]
+
+
+@dataclass
+class Leg:
+    '''
+    Class used to store a leg of a route: consecutive edges of the same kind.
+
+    Attributes
+    ----------
+    kind: str
+        'walk', 'metro' or 'transfer'
+    distance: float
+        meters
+    time: float
+        seconds, with the expected wait for the train of a metro leg
+    line_name: Optional[str]
+    direction: Optional[str]
+        Last station of the line in the direction of travel
+    start_name: Optional[str]
+        Name of the station where the line is taken
+    end_name: Optional[str]
+        Name of the station where the line is left
+    stops: int
+    '''
+    kind: str
+    distance: float = 0
+    time: float = 0
+    line_name: Optional[str] = None
+    direction: Optional[str] = None
+    start_name: Optional[str] = None
+    end_name: Optional[str] = None
+    stops: int = 0
+
+
+@dataclass
+class RouteSummary:
+    '''
+    Class used to store everything the bot needs from a path, computed in a
+    single pass over its edges by route_summary.
+
+    Attributes
+    ----------
+    orig: Coord
+        (lat, lon) of the user
+    dest: Coord
+        (lat, lon) of the destination
+    distance: float
+        Total distance in meters, including the walk to the first node
+    time: float
+        Total time in seconds, including the walk to the first node
+    legs: List[Leg]
+    polylines: List[Polyline]
+        Path edges merged by color, ready to be drawn
+    start: Optional[Coord]
+        Position of the first node of the path
+    end: Optional[Coord]
+        Position of the last node of the path
+    '''
+    orig: Coord
+    dest: Coord
+    distance: float
+    time: float
+    legs: List[Leg] = field(default_factory=list)
+    polylines: List[Polyline] = field(default_factory=list)
+    start: Optional[Coord] = None
+    end: Optional[Coord] = None
+
+
+@dataclass
+class RestaurantNodes:
+    '''
+    Class used to store the nearest street node of every restaurant, which
+    is computed once instead of in every route.
+
+    Attributes
+    ----------
+    rows: Dict[int, int]
+        Row of each restaurant id
+    nodes: np.ndarray
+        Nearest street node of each row
+    '''
+    rows: Dict[int, int]
+    nodes: np.ndarray
+
+
+@dataclass
+class AccessTable:
+    '''
+    Class used to store, for each restaurant, the walking time from its
+    nearest street node to every metro access within ACCESS_RADIUS. The
+    accesses of all the restaurants are stored one after the other (rows of a
+    sparse matrix in CSR format), with the same rows as the RestaurantNodes.
+
+    Attributes
+    ----------
+    snapped: RestaurantNodes
+    indptr: np.ndarray
+        The accesses of row r are in positions indptr[r] to indptr[r+1]
+    accesses: np.ndarray
+        Access node ids (stations connected to the streets included)
+    times: np.ndarray
+        float32 walking time from the restaurant to each access
+    radius: float
+        Walking time (s) used as limit when building the table
+    '''
+    snapped: RestaurantNodes
+    indptr: np.ndarray
+    accesses: np.ndarray
+    times: np.ndarray
+    radius: float
+
+
+@dataclass
+class MetroLinks:
+    '''
+    Class used to store the travel time between every pair of metro nodes
+    (stations and accesses), riding the metro (with the expected wait for
+    each train, see metro.raptor) and also walking between metro nodes which
+    are at most ACCESS_RADIUS apart.
+
+    Attributes
+    ----------
+    matrix: metro.StationMatrix
+        All pairs times and next hops between the metro nodes
+    walks: Dict[Tuple[NodeID, NodeID], float]
+        Walking time between the linked metro nodes
+    radius: float
+        Walking time (s) used as limit for the links
+    timetable: metro.Timetable
+        Lines of the metro, to find the stations of each ride
+    '''
+    matrix: metro.StationMatrix
+    walks: Dict[Tuple[NodeID, NodeID], float]
+    radius: float
+    timetable: metro.Timetable
+
+
+@dataclass
+class Chain:
+    '''
+    Class used to store a chain of street intersections removed by
+    contract_chains, so routes can still start or end at any of them. The
+    positions in the chain are 0 for ends[0], 1 to len(geometry) for the
+    removed nodes and len(geometry)+1 for ends[1].
+
+    Attributes
+    ----------
+    ends: Tuple[NodeID, NodeID]
+    geometry: List[Coord]
+        Position of each removed node, from ends[0] to ends[1]
+    times: List[float]
+        Walking time from ends[0] to each position of the chain
+    distances: List[float]
+        Distance (meters) from ends[0] to each position of the chain
+    '''
+    ends: Tuple[NodeID, NodeID]
+    geometry: List[Coord]
+    times: List[float]
+    distances: List[float]
+
+
+@dataclass
+class Landmarks:
+    '''
+    Class used to store the ALT (A*, landmarks and triangle inequality)
+    tables of a CityGraph: the travel time from every landmark to every
+    node, for both weights. As the graph is undirected, for any landmark L
+    and nodes v, t: time(v, t) >= |time(L, t) - time(L, v)|.
+
+    Attributes
+    ----------
+    codes: np.ndarray
+        Original code of each node id of the graph they were computed for
+    weights: str
+        Fingerprint of the travel times of that graph (see weights_hash)
+    landmarks: np.ndarray
+        Node ids of the landmarks
+    dists: np.ndarray
+        float32 array of shape (2, landmarks, node ids), indexed by the
+        position of the weight in metro.WEIGHTS. Unreachable nodes (and ids
+        removed from the graph) are inf.
+    '''
+    codes: np.ndarray
+    weights: str
+    landmarks: np.ndarray
+    dists: np.ndarray
 
 
 def get_osmnx_graph() -> OsmnxGraph:
@@ -57,10 +275,14 @@ def get_osmnx_graph() -> OsmnxGraph:
             # Necessary to remove self loops
             graph.remove_edges_from(nx.selfloop_edges(graph))
 
-            for edge in graph.edges:
-                distance: float = haversine(graph.nodes[edge[0]]["pos"],
-                                            graph.nodes[edge[1]]["pos"],
-                                            unit="m")
+            # All the edge lengths are computed at once
+            edges: List[Tuple[NodeID, NodeID, int]] = list(graph.edges)
+            ends: np.ndarray = np.array(
+                [graph.nodes[u]["pos"] + graph.nodes[v]["pos"]
+                 for u, v, _ in edges])
+            distances: np.ndarray = geo.distance(ends[:, 1], ends[:, 0],
+                                                 ends[:, 3], ends[:, 2])
+            for edge, distance in zip(edges, distances.tolist()):
                 graph.edges[edge]["distance"] = distance
                 graph.edges[edge]["travel_time"] = distance/WALKING_SPEED
                 graph.edges[edge]["acc_travel_time"] = distance/WALKING_SPEED
@@ -149,7 +371,9 @@ def nearest_nodes(g1: OsmnxGraph, g2: MetroGraph) \
 def build_city_graph(g: OsmnxGraph, g2: MetroGraph) -> CityGraph:
     '''
     Given a OsmnxGraph g1 and a MetroGraph g2, unites both Graphs and connects
-    each access in g2 to the nearest node in g1.
+    each access in g2 to the nearest node in g1. Street intersections are
+    renamed with ids of the IdMap of g2, extended in the graph attribute
+    "ids" (osmids can be translated with routing_node).
 
     Parameters
     ----------
@@ -163,17 +387,272 @@ def build_city_graph(g: OsmnxGraph, g2: MetroGraph) -> CityGraph:
     '''
     nodes, nearest, distances = nearest_nodes(g, g2)
 
+    # The street intersections get ids after the ones of the metro
+    city_ids: ids.IdMap = ids.copy_ids(g2.graph["ids"])
+    street_ids: Dict[int, NodeID] = {
+        osmid: ids.new_id(city_ids, "street_intersection", osmid)
+        for osmid in g.nodes}
+
     # We convert g1 from Multidigraph to graph
-    g1: CityGraph = nx.Graph(g)
+    g1: CityGraph = nx.relabel_nodes(nx.Graph(g), street_ids)
     city: CityGraph = nx.union(g1, g2)
-    for n1, n2, d in zip(nodes, nearest, distances):
+    city.graph["ids"] = city_ids
+    for n1, n2, d in zip(nodes, [street_ids[n] for n in nearest], distances):
         city.add_edge(n1, n2, type="Street", distance=d,
                       travel_time=d/WALKING_SPEED,
                       acc_travel_time=d/WALKING_SPEED)
+    contract_chains(city)
+    # (lat, lon) of the metro nodes, used to bound the routes using the metro
+    city.graph["metro_coords"] = np.array(
+        [(pos[1], pos[0]) for pos in nx.get_node_attributes(g2, "pos")
+         .values()])
     return city
 
 
-def find_path(ox_g: OsmnxGraph, g: CityGraph, src: Coord, dst: Coord,
+def contractible(g: CityGraph, node: NodeID) -> bool:
+    '''
+    Returns whether node is a street intersection in the middle of a street,
+    joined only to two other street intersections
+    '''
+    adj = g.adj[node]
+    return g.nodes[node]['type'] == 'street_intersection' and \
+        len(adj) == 2 and node not in adj and \
+        all(edge['type'] == 'street' for edge in adj.values())
+
+
+def contract_chains(g: CityGraph) -> None:
+    '''
+    Collapses each chain of street intersections in the middle of a street
+    into a single street edge between its two ends, in place. The edge
+    keeps the positions of the removed nodes (from orientation[0] to
+    orientation[1]) as its geometry, so the path is drawn as before. As
+    routes are still snapped to the nodes of the OsmnxGraph, every chain is
+    kept in g.graph["chains"] and each removed node is mapped in
+    g.graph["interior"] to its chain and its position in it, so routes can
+    start or end at it (see chain_links).
+
+    Parameters
+    ----------
+    g: CityGraph
+    '''
+    interior: Dict[NodeID, Tuple[int, int]] = {}
+    chains: List[Chain] = []
+    for a in [node for node in g.nodes if not contractible(g, node)]:
+        for first in list(g.adj[a]):
+            if first in interior or not contractible(g, first):
+                continue
+            chain: List[NodeID] = []
+            times: List[float] = [0]
+            distances: List[float] = [0]
+            prev, node = a, first
+            while contractible(g, node) and node not in interior:
+                distances.append(distances[-1] +
+                                 g.edges[prev, node]['distance'])
+                times.append(times[-1] + g.edges[prev, node]['travel_time'])
+                chain.append(node)
+                interior[node] = (len(chains), len(chain))
+                prev, node = node, next(n for n in g.adj[node] if n != prev)
+            distances.append(distances[-1] + g.edges[prev, node]['distance'])
+            times.append(times[-1] + g.edges[prev, node]['travel_time'])
+            b: NodeID = node
+
+            geometry: List[Coord] = [g.nodes[n]['pos'] for n in chain]
+            chains.append(Chain((a, b), geometry, times, distances))
+            if a != b and (not g.has_edge(a, b) or
+                           times[-1] < g.edges[a, b]['travel_time']):
+                g.add_edge(a, b, type='street', distance=distances[-1],
+                           travel_time=times[-1], acc_travel_time=times[-1],
+                           orientation=(a, b), geometry=geometry)
+            g.remove_nodes_from(chain)
+    g.graph["interior"] = interior
+    g.graph["chains"] = chains
+
+
+def routing_node(g: CityGraph, osmid: int) -> NodeID:
+    '''
+    Returns the node id used to route from or to a node of the OsmnxGraph,
+    given its osmid. The node may have been removed by contract_chains, in
+    which case routes go along its chain (see chain_links).
+    '''
+    return ids.get_id(g.graph["ids"], "street_intersection", osmid)
+
+
+def chain_position(g: CityGraph,
+                   node: NodeID) -> Optional[Tuple[Chain, int]]:
+    '''
+    Returns the Chain of a node removed by contract_chains and its position
+    in it, or None for a node of g
+    '''
+    found: Optional[Tuple[int, int]] = g.graph["interior"].get(node)
+    if found is None:
+        return None
+    return g.graph["chains"][found[0]], found[1]
+
+
+def chain_ends(g: CityGraph, node: NodeID) -> List[Tuple[NodeID, float]]:
+    '''
+    Returns the nodes of g where the routes from or to node start or end,
+    with the walking time between node and them: node itself or, if it was
+    removed by contract_chains, the two ends of its chain.
+    '''
+    found: Optional[Tuple[Chain, int]] = chain_position(g, node)
+    if found is None:
+        return [(node, 0)]
+    chain, k = found
+    return [(chain.ends[0], chain.times[k]),
+            (chain.ends[1], chain.times[-1] - chain.times[k])]
+
+
+def chain_links(g: CityGraph, source: NodeID, targets: Iterable[NodeID]
+                ) -> Dict[NodeID, List[Tuple[NodeID, float]]]:
+    '''
+    Returns the links, with their walking times, that searches from source
+    need to reach it and targets when they were removed by contract_chains:
+    from source to the ends of its chain, from the ends of the chain of
+    each target to it, and from source to the targets in its chain.
+    '''
+    extra: Dict[NodeID, List[Tuple[NodeID, float]]] = {}
+    src: Optional[Tuple[Chain, int]] = chain_position(g, source)
+    if src is not None:
+        extra[source] = chain_ends(g, source)
+    for target in targets:
+        dst: Optional[Tuple[Chain, int]] = chain_position(g, target)
+        if dst is None:
+            continue
+        for end, t in chain_ends(g, target):
+            extra.setdefault(end, []).append((target, t))
+        if src is not None and src[0] is dst[0]:
+            extra[source].append(
+                (target, abs(dst[0].times[dst[1]] - src[0].times[src[1]])))
+    return extra
+
+
+def node_pos(g: CityGraph, node: NodeID) -> Coord:
+    '''
+    Returns the position (lon, lat) of a node of g or removed by
+    contract_chains
+    '''
+    found: Optional[Tuple[Chain, int]] = chain_position(g, node)
+    if found is None:
+        return g.nodes[node]['pos']
+    return found[0].geometry[found[1] - 1]
+
+
+def path_edge(g: CityGraph, u: NodeID, v: NodeID) -> Dict:
+    '''
+    Returns the data of the edge between two consecutive nodes of a path.
+    If one of them was removed by contract_chains it is the part of their
+    chain between them, as a street edge with its geometry.
+    '''
+    found: Optional[Tuple[Chain, int]] = chain_position(g, u) or \
+        chain_position(g, v)
+    if found is None:
+        return g.edges[u, v]
+    chain, k = found
+    last: int = len(chain.geometry) + 1
+
+    def position(node: NodeID) -> int:
+        at: Optional[Tuple[Chain, int]] = chain_position(g, node)
+        if at is not None:
+            return at[1]
+        # An end of the chain, the closest one if both are the same node
+        return min((i for i, end in ((0, chain.ends[0]),
+                                     (last, chain.ends[1])) if end == node),
+                   key=lambda i: abs(chain.times[i] - chain.times[k]))
+
+    i, j = position(u), position(v)
+    lo, hi = min(i, j), max(i, j)
+    return {'type': 'street',
+            'distance': chain.distances[hi] - chain.distances[lo],
+            'travel_time': chain.times[hi] - chain.times[lo],
+            'orientation': (u, v) if i < j else (v, u),
+            'geometry': chain.geometry[lo:hi-1]}
+
+
+def strip_graph(g: CityGraph) -> None:
+    '''
+    Memory-lean mode of the CityGraph, applied in place. Removes the node and
+    edge attributes that routing and drawing never use (the ones left by
+    osmnx), interns the type strings and removes acc_travel_time from the
+    walking edges, where it is the same as travel_time (see edge_time).
+    Metro nodes and edges keep all their attributes.
+
+    Parameters
+    ----------
+    g: CityGraph
+    '''
+    for node, data in g.nodes.items():
+        if data['type'] == 'street_intersection':
+            pos: Coord = data['pos']
+            data.clear()
+            data['pos'] = pos
+            data['type'] = 'street_intersection'
+        else:
+            data['type'] = sys.intern(data['type'])
+    for u, v, data in g.edges(data=True):
+        if data['type'] in WALK_TYPES:
+            kept: Dict[str, Any] = {key: data[key] for key in STREET_ATTRS
+                                    if key in data}
+            data.clear()
+            data.update(kept)
+        data['type'] = sys.intern(data['type'])
+
+
+def graph_bytes(g: CityGraph) -> Tuple[float, float]:
+    '''
+    Returns the average memory (bytes) used by each node and by each edge of
+    g, with their attribute dicts. Objects shared by several nodes or edges
+    (like interned strings) are counted once.
+    '''
+    seen: set = set()
+
+    def size(obj: Any) -> int:
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        total: int = sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            total += sum(size(k) + size(v) for k, v in obj.items())
+        elif isinstance(obj, (list, tuple)):
+            total += sum(size(item) for item in obj)
+        return total
+
+    nodes: int = sum(size(node) + size(data) for node, data in g.nodes.items())
+    edges: int = sum(size(data) for _, _, data in g.edges(data=True))
+    # Each edge is in the adjacency dicts of both ends
+    adjacency: int = sum(sys.getsizeof(adj) for adj in g.adj.values())
+    return (nodes/max(len(g), 1),
+            (edges + adjacency)/max(g.number_of_edges(), 1))
+
+
+def edge_time(edge: Dict, accessibility: bool = False) -> float:
+    '''
+    Returns the travel time of an edge. Walking edges of a stripped graph
+    (see strip_graph) do not store acc_travel_time.
+    '''
+    if accessibility:
+        return edge.get('acc_travel_time', edge['travel_time'])
+    return edge['travel_time']
+
+
+def route_weight(accessibility: bool = False) -> Union[str, Callable]:
+    '''Returns the weight used by networkx to find the routes'''
+    if accessibility:
+        return lambda u, v, edge: edge_time(edge, True)
+    return 'travel_time'
+
+
+def nearest_node(ox_g: OsmnxGraph, g: CityGraph, coord: Coord) -> NodeID:
+    '''
+    Returns the node used to route from or to coord, the (lat, lon) of any
+    point. It may have been removed from g (see routing_node).
+    '''
+    return routing_node(g, ox.distance.nearest_nodes(ox_g, coord[1],
+                                                     coord[0]))
+
+
+def find_path(ox_g: OsmnxGraph, g: CityGraph, src: Coord,
+              dst: Union[Coord, NodeID],
               accessibility: bool = False) -> Path:
     '''
     Given a CityGraph g, a starting point src and a destination point dst we
@@ -181,6 +660,8 @@ def find_path(ox_g: OsmnxGraph, g: CityGraph, src: Coord, dst: Coord,
     we return the path.
     Depending on the accessibility parameter (which is false by default) will
     be accessible or not.
+    The waits for the trains are not counted, as the metro is part of the
+    graph (find_restaurant_path counts them).
 
     Parameters:
     -----------
@@ -188,8 +669,9 @@ def find_path(ox_g: OsmnxGraph, g: CityGraph, src: Coord, dst: Coord,
     g: CityGraph
     src: Coord
         Coordinates of the source point.
-    dst:Coord
-        Coordinates of the destination.
+    dst: Union[Coord, NodeID]
+        Coordinates of the destination, or its node if it is already known
+        (see snap_restaurants).
     accessibility: bool
         False by default
 
@@ -197,84 +679,958 @@ def find_path(ox_g: OsmnxGraph, g: CityGraph, src: Coord, dst: Coord,
     -------
     p: Path
     '''
-    src_node: NodeID = ox.distance.nearest_nodes(ox_g, src[1], src[0])
-    dst_node: NodeID = ox.distance.nearest_nodes(ox_g, dst[1], dst[0])
-    weight_param: str = 'acc_travel_time' if accessibility else 'travel_time'
-    p: Path = nx.shortest_path(g, src_node, dst_node, weight=weight_param)
+    src_node: NodeID = nearest_node(ox_g, g, src)
+    dst_node: NodeID = nearest_node(ox_g, g, dst) \
+        if isinstance(dst, tuple) else dst
+    short: Optional[Path] = short_walk(g, src_node, dst_node)
+    if short is not None:
+        return short
+    lm: Optional[Landmarks] = g.graph.get("landmarks")
+    if lm is None:
+        return astar_path(g, src_node, dst_node,
+                          np.zeros(len(g.graph["ids"].kinds)), accessibility)
+    # A removed destination is reached from one of the ends of its chain
+    h: np.ndarray = np.min([alt_bounds(lm, end, accessibility) + t
+                            for end, t in chain_ends(g, dst_node)], axis=0)
+    h[dst_node] = 0  # the landmarks do not reach removed nodes
+    return astar_path(g, src_node, dst_node, h, accessibility)
+
+
+def astar_path(g: CityGraph, source: NodeID, target: NodeID, h: np.ndarray,
+               accessibility: bool = False) -> Path:
+    '''
+    A* search of the fastest path from source to target over every edge of
+    g, where h is a lower bound of the travel time from each node id to
+    target. Source and target may have been removed by contract_chains (see
+    chain_links).
+
+    Parameters
+    ----------
+    g: CityGraph
+    source: NodeID
+    target: NodeID
+    h: np.ndarray
+    accessibility: bool
+        False by default
+
+    Returns
+    -------
+    p: Path
+    '''
+    extra: Dict[NodeID, List[Tuple[NodeID, float]]] = \
+        chain_links(g, source, [target])
+    dist: Dict[NodeID, float] = {source: 0}
+    pred: Dict[NodeID, NodeID] = {}
+    settled: set = set()
+    heap: List[Tuple[float, NodeID]] = [(float(h[source]), source)]
+
+    def relax(u: NodeID, v: NodeID, new_d: float) -> None:
+        if v not in settled and new_d < dist.get(v, float('inf')):
+            dist[v] = new_d
+            pred[v] = u
+            heapq.heappush(heap, (new_d + float(h[v]), v))
+
+    while heap:
+        _, u = heapq.heappop(heap)
+        if u == target:
+            return walk_path(pred, source, target)
+        if u in settled:
+            continue
+        settled.add(u)
+        d: float = dist[u]
+        for v, t in extra.get(u, ()):
+            relax(u, v, d + t)
+        if u in g:
+            for v, edge in g.adj[u].items():
+                relax(u, v, d + edge_time(edge, accessibility))
+    raise nx.NetworkXNoPath("target can not be reached")
+
+
+def build_landmarks(g: CityGraph, k: int = N_LANDMARKS) -> Landmarks:
+    '''
+    Chooses k street intersections of g spread around the city and computes
+    the travel time from each of them to every node, for both weights.
+    The first landmark is the intersection farthest from the center, and
+    each following one the intersection farthest (in travel time) from the
+    ones already chosen, which leaves them around the border of Barcelona.
+
+    Parameters
+    ----------
+    g: CityGraph
+    k: int
+
+    Returns
+    -------
+    Landmarks
+    '''
+    n: int = len(g.graph["ids"].kinds)
+    nodes: np.ndarray = np.array(list(g.nodes), dtype=np.int64)
+    streets: np.ndarray = np.zeros(n, dtype=bool)
+    streets[nodes] = [g.nodes[node]['type'] == 'street_intersection'
+                      for node in nodes.tolist()]
+    pos: np.ndarray = np.zeros((n, 2))
+    pos[nodes] = [g.nodes[node]['pos'] for node in nodes.tolist()]
+    dists: np.ndarray = np.full((len(metro.WEIGHTS), k, n), np.inf,
+                                dtype=np.float32)
+
+    # Distance of each candidate to the center, then to the closest landmark
+    spread: np.ndarray = np.where(
+        streets, ((pos - pos[streets].mean(axis=0))**2).sum(axis=1), -1)
+    landmarks: List[NodeID] = []
+    for i in range(k):
+        landmark: NodeID = int(np.argmax(spread))
+        landmarks.append(landmark)
+        for w in range(len(metro.WEIGHTS)):
+            lengths: Dict[NodeID, float] = \
+                nx.single_source_dijkstra_path_length(
+                    g, landmark, weight=route_weight(bool(w)))
+            dists[w, i, list(lengths)] = list(lengths.values())
+        # Only the nodes connected to the first landmark are candidates
+        spread = np.where(streets & np.isfinite(dists[0, 0]),
+                          dists[0, :i+1].min(axis=0), -1)
+    return Landmarks(np.array(g.graph["ids"].codes, dtype=np.int64),
+                     weights_hash(g), np.array(landmarks), dists)
+
+
+def weights_hash(g: CityGraph) -> str:
+    '''
+    Returns a fingerprint of the travel times of every edge of g, for both
+    weights, which is the same whether g is stripped (see strip_graph) or
+    not.
+    '''
+    edges: np.ndarray = np.array(
+        [(min(u, v), max(u, v), edge_time(edge), edge_time(edge, True))
+         for u, v, edge in g.edges(data=True)], dtype=np.float64)
+    edges = edges.reshape(-1, 4)
+    edges = edges[np.lexsort(edges.T[::-1])]
+    return hashlib.sha256(edges.tobytes()).hexdigest()
+
+
+def alt_bounds(lm: Landmarks, target: NodeID,
+               accessibility: bool = False) -> np.ndarray:
+    '''
+    Returns, for every node id, a lower bound of its travel time to target,
+    using the landmarks that reach target.
+    '''
+    dists: np.ndarray = lm.dists[int(accessibility)]
+    to_target: np.ndarray = dists[:, target]
+    useful: np.ndarray = np.isfinite(to_target)
+    if not useful.any():
+        return np.zeros(dists.shape[1], dtype=np.float32)
+    bounds: np.ndarray = np.abs(
+        dists[useful] - to_target[useful, None]).max(axis=0)
+    return np.maximum(bounds - ALT_SLACK, 0)
+
+
+def save_landmarks(lm: Landmarks, filename: str) -> None:
+    '''
+        Saves the Landmarks lm as filename to the current directory
+    '''
+    try:
+        np.savez(filename, codes=lm.codes, weights=lm.weights,
+                 landmarks=lm.landmarks, dists=lm.dists)
+    except Exception:
+        print("Error while saving landmarks")
+
+
+def load_landmarks(g: CityGraph, filename: str) -> Optional[Landmarks]:
+    '''
+        Loads the Landmarks of g from filename. Returns None if they do not
+        exist or were computed for a different graph (other nodes or other
+        travel times).
+    '''
+    if not os.path.exists(filename):
+        return None
+    try:
+        data = np.load(filename)
+        codes: np.ndarray = data['codes']
+        if not np.array_equal(codes, g.graph["ids"].codes) or \
+                'weights' not in data or \
+                str(data['weights']) != weights_hash(g):
+            return None
+        return Landmarks(codes, str(data['weights']), data['landmarks'],
+                         data['dists'])
+    except Exception:
+        print("Could not retrieve landmarks")
+        return None
+
+
+def get_landmarks(g: CityGraph) -> Landmarks:
+    '''
+    Returns the Landmarks of g, which are loaded from LANDMARKS_FILENAME
+    (saved next to the graph) or computed and saved if they are missing or
+    outdated. They are also stored in g, so find_path uses them.
+    '''
+    lm: Optional[Landmarks] = load_landmarks(g, LANDMARKS_FILENAME)
+    if lm is None:
+        lm = build_landmarks(g)
+        save_landmarks(lm, LANDMARKS_FILENAME)
+    g.graph["landmarks"] = lm
+    return lm
+
+
+def snap_restaurants(ox_g: OsmnxGraph, g: CityGraph,
+                     rsts: List) -> RestaurantNodes:
+    '''
+    Finds the nearest street node of every restaurant, all at once.
+
+    Parameters
+    ----------
+    ox_g: OsmnxGraph
+    g: CityGraph
+    rsts: Restaurants
+
+    Returns
+    -------
+    RestaurantNodes
+    '''
+    nodes = ox.distance.nearest_nodes(ox_g, [rst.coords[1] for rst in rsts],
+                                      [rst.coords[0] for rst in rsts])
+    return RestaurantNodes({rst.id: row for row, rst in enumerate(rsts)},
+                           np.array([routing_node(g, node) for node in nodes],
+                                    dtype=np.int64))
+
+
+def restaurant_node(snapped: RestaurantNodes,
+                    rst_id: int) -> Optional[NodeID]:
+    '''Returns the nearest street node of a restaurant, if it is known'''
+    row: Optional[int] = snapped.rows.get(rst_id)
+    return None if row is None else int(snapped.nodes[row])
+
+
+def walk_dijkstra(g: CityGraph, source: NodeID, pred: Dict[NodeID, NodeID],
+                  bounds: Optional[Tuple[float, float, float, float]] = None,
+                  targets: Iterable[NodeID] = ()
+                  ) -> Iterator[Tuple[NodeID, float]]:
+    '''
+    Dijkstra over the street (walking) edges of g. Yields the reached nodes
+    and their walking time from source in increasing order of time, so the
+    caller can stop the search whenever it wants. Metro accesses and
+    stations are reached, as they are connected to the streets, but the
+    search never goes inside the metro. Source and the targets may have
+    been removed by contract_chains (see chain_links).
+
+    Parameters
+    ----------
+    g: CityGraph
+    source: NodeID
+    pred: Dict[NodeID, NodeID]
+        Filled with the predecessor of every reached node
+    bounds: Optional[Tuple[float, float, float, float]]
+        (min lon, min lat, max lon, max lat) of the nodes that can be reached
+    targets: Iterable[NodeID]
+        Nodes removed by contract_chains which have to be reached, the
+        rest are ignored
+
+    Returns
+    -------
+    Iterator[Tuple[NodeID, float]]
+    '''
+    extra: Dict[NodeID, List[Tuple[NodeID, float]]] = \
+        chain_links(g, source, targets)
+    dist: Dict[NodeID, float] = {source: 0}
+    settled: set = set()
+    heap: List[Tuple[float, NodeID]] = [(0, source)]
+    while heap:
+        d, u = heapq.heappop(heap)
+        if u in settled:
+            continue
+        settled.add(u)
+        yield u, d
+        for v, t in extra.get(u, ()):
+            if v not in settled and d + t < dist.get(v, float('inf')):
+                dist[v] = d + t
+                pred[v] = u
+                heapq.heappush(heap, (d + t, v))
+        if u not in g:
+            continue
+        for v, edge in g.adj[u].items():
+            if edge['type'] in WALK_TYPES and v not in settled:
+                if bounds is not None:
+                    x, y = g.nodes[v]['pos']
+                    if not (bounds[0] <= x <= bounds[2] and
+                            bounds[1] <= y <= bounds[3]):
+                        continue
+                new_d: float = d + edge['travel_time']
+                if new_d < dist.get(v, float('inf')):
+                    dist[v] = new_d
+                    pred[v] = u
+                    heapq.heappush(heap, (new_d, v))
+
+
+def walk_path(pred: Dict[NodeID, NodeID], source: NodeID,
+              target: NodeID) -> Path:
+    '''Returns the path from source to target given the predecessors'''
+    p: Path = [target]
+    while p[-1] != source:
+        p.append(pred[p[-1]])
+    return p[::-1]
+
+
+def walk_between(g: CityGraph, source: NodeID, target: NodeID) -> Path:
+    '''Returns the shortest walking path between two nodes'''
+    pred: Dict[NodeID, NodeID] = {}
+    for u, _ in walk_dijkstra(g, source, pred, targets=[target]):
+        if u == target:
+            return walk_path(pred, source, target)
+    raise nx.NetworkXNoPath("target can not be reached walking")
+
+
+def short_walk(g: CityGraph, src_node: NodeID,
+               dst_node: NodeID) -> Optional[Path]:
+    '''
+    Planner tier for short trips. If src_node and dst_node are at most
+    SHORT_TRIP meters apart, searches a walking path only in the streets of
+    a box around them. The path is returned only when it is the one
+    find_path would find: a walk leaving the box would be longer, and so
+    would any route through the metro, which at least has to walk to and
+    from the closest metro nodes. Otherwise returns None.
+
+    Parameters
+    ----------
+    g: CityGraph
+    src_node: NodeID
+    dst_node: NodeID
+
+    Returns
+    -------
+    Optional[Path]
+    '''
+    if src_node == dst_node:
+        return [src_node]
+    (x0, y0), (x1, y1) = node_pos(g, src_node), node_pos(g, dst_node)
+    dist: float = geo.distance(y0, x0, y1, x1)
+    if dist > SHORT_TRIP:
+        return None
+
+    margin: float = max(BBOX_MARGIN, dist)
+    dlat: float = margin/METERS_PER_DEGREE
+    dlon: float = dlat/cos(radians(max(abs(y0), abs(y1))))
+    bounds: Tuple[float, float, float, float] = (
+        min(x0, x1) - dlon, min(y0, y1) - dlat,
+        max(x0, x1) + dlon, max(y0, y1) + dlat)
+    metro_coords: np.ndarray = g.graph["metro_coords"]
+    to_metro: np.ndarray = geo.one_to_many((y0, x0), metro_coords)
+    from_metro: np.ndarray = geo.one_to_many((y1, x1), metro_coords)
+    cutoff: float = min(2*margin, to_metro.min() + from_metro.min()) \
+        / WALKING_SPEED
+
+    pred: Dict[NodeID, NodeID] = {}
+    for u, d in walk_dijkstra(g, src_node, pred, bounds, [dst_node]):
+        if d > cutoff:
+            return None
+        if u == dst_node:
+            break
+    else:
+        return None
+    return walk_path(pred, src_node, dst_node)
+
+
+def metro_nodes_within(g: CityGraph, source: NodeID,
+                       cutoff: float) -> List[Tuple[NodeID, float]]:
+    '''
+    Returns the metro nodes (accesses and stations, which are also connected
+    to the streets) reachable walking from source in at most cutoff seconds,
+    together with the walking time.
+    '''
+    found: List[Tuple[NodeID, float]] = []
+    for u, d in walk_dijkstra(g, source, {}):
+        if d > cutoff:
+            break
+        if u != source and g.nodes[u]['type'] in METRO_TYPES:
+            found.append((u, d))
+    return found
+
+
+def build_metro_links(g: CityGraph,
+                      radius: float = ACCESS_RADIUS) -> MetroLinks:
+    '''
+    Computes the travel time between every pair of metro nodes of g. Routes
+    can ride the metro, found with metro.raptor so that every train boarded
+    costs its expected wait, and walk between metro nodes at most radius
+    meters apart, which is how find_path may change lines.
+
+    Parameters
+    ----------
+    g: CityGraph
+    radius: float
+        meters
+
+    Returns
+    -------
+    MetroLinks
+    '''
+    cutoff: float = radius/WALKING_SPEED
+    nodes: List[NodeID] = [node for node, node_type in g.nodes(data='type')
+                           if node_type in METRO_TYPES]
+    links: nx.Graph = nx.Graph()
+    links.add_nodes_from(nodes)
+    for u, v, edge in g.subgraph(nodes).edges(data=True):
+        if edge['type'] == 'access':
+            links.add_edge(u, v, **{w: edge_time(edge, bool(i))
+                                    for i, w in enumerate(metro.WEIGHTS)})
+    # Rides between every pair of stations, instead of the line and transfer
+    # edges. Lines run both ways with the same headway, so they are the same
+    # in both directions.
+    tt: metro.Timetable = metro.build_timetable(g)
+    rides: np.ndarray = np.array([metro.ride_times(tt, bool(i))
+                                  for i in range(len(metro.WEIGHTS))])
+    for i, j in zip(*np.triu_indices(len(tt.ids), 1)):
+        if np.isfinite(rides[:, i, j]).any():
+            links.add_edge(int(tt.ids[i]), int(tt.ids[j]),
+                           **{w: float(rides[k, i, j])
+                              for k, w in enumerate(metro.WEIGHTS)})
+
+    walks: Dict[Tuple[NodeID, NodeID], float] = {}
+    for node in nodes:
+        for u, d in metro_nodes_within(g, node, cutoff):
+            walks[node, u] = d
+            if links.has_edge(node, u):
+                edge = links.edges[node, u]
+                for w in metro.WEIGHTS:
+                    edge[w] = min(edge[w], d)
+            else:
+                links.add_edge(node, u, **{w: d for w in metro.WEIGHTS})
+    return MetroLinks(metro.get_station_matrix(links, nodes), walks, cutoff,
+                      tt)
+
+
+def links_path(g: CityGraph, links: MetroLinks, orig_id: NodeID,
+               dest_id: NodeID, accessibility: bool = False) -> Path:
+    '''
+    Returns the path in g between two metro nodes given by the MetroLinks,
+    expanding the rides to their stations and the walks between metro nodes
+    to street paths.
+    '''
+    nodes: Path = metro.station_path(links.matrix, orig_id, dest_id,
+                                     accessibility)
+    p: Path = nodes[:1]
+    for u, v in zip(nodes, nodes[1:]):
+        walk: float = links.walks.get((u, v), float('inf'))
+        if u in links.timetable.index and v in links.timetable.index:
+            ride, stations = metro.metro_route(links.timetable, u, v,
+                                               accessibility=accessibility)
+            if ride <= walk:
+                p += stations[1:]
+                continue
+        if g.has_edge(u, v) and g.edges[u, v]['type'] == 'access' and \
+                edge_time(g.edges[u, v], accessibility) <= walk:
+            p.append(v)
+        else:
+            p += walk_between(g, u, v)[1:]
     return p
 
 
-def plot(g: MetroGraph, filename: str) -> None:
+def build_access_table(g: CityGraph, snapped: RestaurantNodes,
+                       radius: float = ACCESS_RADIUS) -> AccessTable:
+    '''
+    Walking from the nearest street node of every restaurant, finds the metro
+    accesses (and stations) that can be reached within radius meters.
+
+    Parameters
+    ----------
+    g: CityGraph
+    snapped: RestaurantNodes
+    radius: float
+        meters
+
+    Returns
+    -------
+    AccessTable
+    '''
+    cutoff: float = radius/WALKING_SPEED
+    indptr: List[int] = [0]
+    accesses: List[NodeID] = []
+    times: List[float] = []
+    for node in snapped.nodes.tolist():
+        for u, d in metro_nodes_within(g, node, cutoff):
+            accesses.append(u)
+            times.append(d)
+        indptr.append(len(accesses))
+    return AccessTable(snapped, np.array(indptr, dtype=np.int64),
+                       np.array(accesses, dtype=np.int64),
+                       np.array(times, dtype=np.float32), cutoff)
+
+
+def update_access_table(ox_g: OsmnxGraph, g: CityGraph, table: AccessTable,
+                        rsts: List, removed: List[int]) -> AccessTable:
+    '''
+    Returns a new AccessTable after the restaurants have been reloaded: the
+    restaurants in rsts (new or changed) are snapped and their accesses found
+    again, the removed ones are deleted and the rest are copied. The given
+    table is not modified.
+
+    Parameters
+    ----------
+    ox_g: OsmnxGraph
+    g: CityGraph
+    table: AccessTable
+    rsts: Restaurants
+        Added and changed restaurants
+    removed: List[int]
+        Ids of the removed restaurants
+
+    Returns
+    -------
+    AccessTable
+    '''
+    dropped: set = set(removed) | {rst.id for rst in rsts}
+    kept: List[Tuple[int, int]] = [(rst_id, row) for rst_id, row in
+                                   table.snapped.rows.items()
+                                   if rst_id not in dropped]
+    old_rows: np.ndarray = np.array([row for _, row in kept], dtype=np.int64)
+    starts: np.ndarray = table.indptr[old_rows]
+    lengths: np.ndarray = table.indptr[old_rows + 1] - starts
+    # Positions in table.accesses of the accesses of the kept rows
+    positions: np.ndarray = np.repeat(starts - np.cumsum(lengths) + lengths,
+                                      lengths) + np.arange(lengths.sum())
+
+    fresh: AccessTable = build_access_table(
+        g, snap_restaurants(ox_g, g, rsts), table.radius*WALKING_SPEED) \
+        if rsts else AccessTable(RestaurantNodes({}, np.empty(0, np.int64)),
+                                 np.zeros(1, np.int64), np.empty(0, np.int64),
+                                 np.empty(0, np.float32), table.radius)
+    rows: Dict[int, int] = {rst_id: row for row, (rst_id, _) in
+                            enumerate(kept)}
+    rows.update({rst_id: len(kept) + row for rst_id, row in
+                 fresh.snapped.rows.items()})
+    indptr: np.ndarray = np.concatenate(
+        (np.concatenate(([0], np.cumsum(lengths))),
+         lengths.sum() + fresh.indptr[1:])).astype(np.int64)
+    return AccessTable(
+        RestaurantNodes(rows, np.concatenate(
+            (table.snapped.nodes[old_rows], fresh.snapped.nodes))),
+        indptr,
+        np.concatenate((table.accesses[positions], fresh.accesses)),
+        np.concatenate((table.times[positions], fresh.times)),
+        table.radius)
+
+
+def find_restaurant_path(ox_g: OsmnxGraph, g: CityGraph, links: MetroLinks,
+                         table: AccessTable, src: Coord, dst: Coord,
+                         rst_id: int, accessibility: bool = False,
+                         src_node: Optional[NodeID] = None) -> Path:
+    '''
+    Same as find_path for a destination which is a restaurant of the access
+    table. Only the walk from src is searched: the walk at the restaurant end
+    comes from the table and the rest of the route from the metro links. The
+    search stops as soon as no route can be faster than the best one found.
+
+    Walks between two metro nodes are limited to the links radius. When the
+    walk at the restaurant end may be longer than the table radius, the
+    accesses further away are searched from the restaurant.
+
+    Parameters
+    ----------
+    ox_g: OsmnxGraph
+    g: CityGraph
+    links: MetroLinks
+    table: AccessTable
+    src: Coord
+    dst: Coord
+        Coordinates of the restaurant
+    rst_id: int
+    accessibility: bool
+        False by default
+    src_node: Optional[NodeID]
+        Node of src (see nearest_node), if it is already known
+
+    Returns
+    -------
+    p: Path
+    '''
+    return find_restaurant_paths(ox_g, g, links, table, src, [(dst, rst_id)],
+                                 accessibility, src_node)[0]
+
+
+def find_restaurant_paths(ox_g: OsmnxGraph, g: CityGraph, links: MetroLinks,
+                          table: AccessTable, src: Coord,
+                          dsts: List[Tuple[Coord, int]],
+                          accessibility: bool = False,
+                          src_node: Optional[NodeID] = None,
+                          cancelled: Optional[Callable[[], bool]] = None
+                          ) -> List[Path]:
+    '''
+    Same as find_restaurant_path for several restaurants, given by their
+    (coordinates, id), with a single search from src which stops when no
+    route to any of them can be improved. If cancelled is given, it is
+    checked during the search and an empty list is returned once it is true.
+    Restaurants missing from the table are snapped and their accesses found
+    here, so every metro route charges the waits of metro.raptor.
+    '''
+    if src_node is None:
+        src_node = nearest_node(ox_g, g, src)
+    m: metro.StationMatrix = links.matrix
+    times: np.ndarray = m.times[int(accessibility)]
+    paths: List[Optional[Path]] = [None] * len(dsts)
+    # Node, accesses, walking times and matrix positions of the accesses of
+    # each restaurant which needs the search
+    targets: Dict[int, Tuple[NodeID, List[NodeID], np.ndarray,
+                             np.ndarray]] = {}
+    for i, (dst, rst_id) in enumerate(dsts):
+        row: Optional[int] = table.snapped.rows.get(rst_id)
+        dst_node: NodeID = nearest_node(ox_g, g, dst) if row is None \
+            else int(table.snapped.nodes[row])
+        paths[i] = short_walk(g, src_node, dst_node)
+        if paths[i] is None:
+            if row is None:
+                found: List[Tuple[NodeID, float]] = metro_nodes_within(
+                    g, dst_node, table.radius)
+                accesses: List[NodeID] = [a for a, _ in found]
+                tail: np.ndarray = np.array([d for _, d in found],
+                                            dtype=np.float32)
+            else:
+                accesses = table.accesses[
+                    table.indptr[row]:table.indptr[row+1]].tolist()
+                tail = table.times[table.indptr[row]:table.indptr[row+1]]
+            targets[i] = (dst_node, accesses, tail,
+                          np.array([m.index[a] for a in accesses],
+                                   dtype=np.int64))
+    if not targets:
+        return cast(List[Path], paths)
+
+    # Forward search from the user, entries keeps the metro nodes reached
+    best: Dict[int, float] = {i: float('inf') for i in targets}
+    walk_time: Dict[int, float] = dict(best)
+    at_node: Dict[NodeID, List[int]] = {}
+    for i, target in targets.items():
+        at_node.setdefault(target[0], []).append(i)
+    entries: List[Tuple[NodeID, float]] = []
+    pred: Dict[NodeID, NodeID] = {}
+    for n, (u, d) in enumerate(walk_dijkstra(g, src_node, pred,
+                                             targets=list(at_node))):
+        if d >= max(best.values()):
+            break
+        if cancelled is not None and n % CANCEL_CHECK == 0 and cancelled():
+            return []
+        if u in at_node:
+            for i in at_node[u]:
+                best[i] = walk_time[i] = d
+        elif u != src_node and g.nodes[u]['type'] in METRO_TYPES:
+            entries.append((u, d))
+            for i, (_, _, tail, dst_index) in targets.items():
+                if len(tail):
+                    best[i] = min(best[i], d + float(np.min(
+                        times[m.index[u], dst_index] + tail)))
+
+    for i, (dst_node, dst_accesses, tail, dst_index) in targets.items():
+        if cancelled is not None and cancelled():
+            return []
+        # Any route not seen walks more than the table radius at the end
+        if entries and best[i] > entries[0][1] + table.radius:
+            extra: List[Tuple[NodeID, float]] = metro_nodes_within(
+                g, dst_node, best[i] - entries[0][1])
+            dst_accesses = [a for a, _ in extra]
+            tail = np.array([d for _, d in extra])
+            dst_index = np.array([m.index[a] for a in dst_accesses],
+                                 dtype=np.int64)
+
+        # We choose the best metro route among the reached metro nodes
+        if entries and len(tail):
+            src_index: np.ndarray = np.array([m.index[u] for u, _ in entries])
+            total: np.ndarray = np.array([d for _, d in entries])[:, None] + \
+                times[np.ix_(src_index, dst_index)] + tail[None, :]
+            j, k = np.unravel_index(np.argmin(total), total.shape)
+            if total[j, k] < walk_time[i]:
+                paths[i] = walk_path(pred, src_node, entries[j][0]) + \
+                    links_path(g, links, entries[j][0], dst_accesses[k],
+                               accessibility)[1:] + \
+                    walk_between(g, dst_accesses[k], dst_node)[1:]
+                continue
+
+        # Every walk and metro route has been tried
+        if walk_time[i] == float('inf'):
+            raise nx.NetworkXNoPath("target can not be reached")
+        paths[i] = walk_path(pred, src_node, dst_node)
+    return cast(List[Path], paths)
+
+
+def plot(g: CityGraph, filename: str,
+         min_node_px: float = NODE_LOD_PX) -> None:
     '''
     Given a CityGraph g and a filename we create an image of the graph
-    g and save it with the corresponding filename
+    g and save it with the corresponding filename.
+    The graph is drawn directly over the tiles with PIL instead of adding a
+    staticmap feature for every node and edge, which is too slow at city
+    scale.
+
+    Parameters
+    ----------
+    g: CityGraph
+    filename: str
+    min_node_px: float
+        Level of detail. Street intersections closer than min_node_px pixels
+        to an already drawn one are not drawn. 0 draws all of them.
     '''
     # color for each set of edges, blue is the default
-
     colorEdges: Dict[str, str] = {'line': 'blue', 'street': 'yellow',
                                   'transfer': 'orange', 'Street': 'orange',
                                   'access': 'blue'}
     colorNodes: Dict[str, str] = {'station': 'red', 'access': 'black',
                                   'street_intersection': 'green'}
-    map: StaticMap = StaticMap(
-        SIZE_X, SIZE_Y, url_template='http://a.tile.osm.org/{z}/{x}/{y}.png')
-    for u, node in g.nodes(data=True):
-        map.add_marker(CircleMarker(node.get('pos'),
-                       colorNodes.get(node.get('type'), 'green'), 4))
-    for edge in g.edges(data=True):
-        n0: Coord = g.nodes[edge[0]]['pos']
-        n1: Coord = g.nodes[edge[1]]['pos']
-        map.add_line(Line([n0, n1], colorEdges[edge[2]['type']], 2))
+
+    # We project all the nodes to pixels at once
+    nodes: List[NodeID] = list(g.nodes)
+    index: Dict[NodeID, int] = {node: i for i, node in enumerate(nodes)}
+    coords: np.ndarray = np.array([g.nodes[node]['pos'] for node in nodes],
+                                  dtype=float)
+    lon_min, lat_min = coords.min(axis=0)
+    lon_max, lat_max = coords.max(axis=0)
+    zoom: int = fit_zoom([(lon_min, lat_min), (lon_max, lat_max)])
+    center: Coord = ((lon_min + lon_max) / 2, (lat_min + lat_max) / 2)
+    px: np.ndarray = project(coords, zoom, center)
+
     try:
-        image = map.render()
+        map: StaticMap = metro.TimedMap(
+            SIZE_X, SIZE_Y,
+            url_template='http://a.tile.osm.org/{z}/{x}/{y}.png')
+        image = map.render(zoom=zoom, center=center)
+        draw = ImageDraw.Draw(image)
+
+        # Edges are drawn in batches of the same color
+        edges: Dict[str, List[Tuple[int, int]]] = {}
+        for u, v, edge in g.edges(data=True):
+            if 'geometry' not in edge:
+                edges.setdefault(colorEdges.get(edge['type'], 'blue'),
+                                 []).append((index[u], index[v]))
+        for color, pairs in edges.items():
+            ends: np.ndarray = np.array(pairs)
+            segments: np.ndarray = np.hstack((px[ends[:, 0]], px[ends[:, 1]]))
+            for segment in segments.tolist():
+                draw.line(segment, fill=color, width=EDGE_WIDTH)
+        # Contracted streets are drawn through their geometry
+        for u, v, geometry in g.edges(data='geometry'):
+            if geometry:
+                line: np.ndarray = project(np.array(geometry), zoom, center)
+                line = np.vstack((px[index[u]], line, px[index[v]])) \
+                    if g.edges[u, v]['orientation'][0] == u \
+                    else np.vstack((px[index[v]], line, px[index[u]]))
+                draw.line(line.flatten().tolist(),
+                          fill=colorEdges['street'], width=EDGE_WIDTH)
+
+        types: List[str] = [g.nodes[node].get('type') for node in nodes]
+        drawn: np.ndarray = np.ones(len(nodes), dtype=bool)
+        if min_node_px > 0:
+            streets: np.ndarray = np.array(
+                [t == 'street_intersection' for t in types], dtype=bool)
+            cells: np.ndarray = np.floor(px[streets] / min_node_px)
+            _, first = np.unique(cells, axis=0, return_index=True)
+            kept: np.ndarray = np.zeros(int(streets.sum()), dtype=bool)
+            kept[first] = True
+            drawn[streets] = kept
+        for i in np.flatnonzero(drawn).tolist():
+            x, y = px[i]
+            draw.ellipse((x - NODE_RADIUS, y - NODE_RADIUS,
+                          x + NODE_RADIUS, y + NODE_RADIUS),
+                         fill=colorNodes.get(types[i], 'green'))
         image.save(filename)
     except Exception:
         print("Could not render or save image")
 
 
-def edge_color(g: CityGraph, n1: NodeID, n2: NodeID) -> str:
-    '''Returns the appropiate color for an edge'''
-    try:
-        edge = g.edges[(n1, n2)]
-        if edge['type'] == 'line':
-            return "#"+edge['line_colour']
-        elif edge['type'] == 'transfer':
-            return TRANSFER_COLOR
-        elif edge['type'] == 'access':
-            return ACCESS_COLOR
-        return STREET_COLOR
-    except Exception as e:
-        print(e)
-        return 'black'
+def edge_color(edge: Dict) -> str:
+    '''Returns the appropiate color for an edge given its data'''
+    if edge['type'] == 'line':
+        return "#"+edge['line_colour']
+    elif edge['type'] == 'transfer':
+        return TRANSFER_COLOR
+    elif edge['type'] == 'access':
+        return ACCESS_COLOR
+    return STREET_COLOR
+
+
+def lon_to_px(lon: float, zoom: int) -> float:
+    '''Returns the web mercator x pixel coordinate of lon at a given zoom'''
+    return (lon + 180) / 360 * TILE_SIZE * 2**zoom
 
 
-def plot_path(g: CityGraph, p: Path, filename: str,
-              orig: Coord, dest: Coord) -> None:
+def lat_to_px(lat: float, zoom: int) -> float:
+    '''Returns the web mercator y pixel coordinate of lat at a given zoom'''
+    lat = radians(lat)
+    return (1 - log(tan(lat) + 1 / cos(lat)) / pi) / 2 * TILE_SIZE * 2**zoom
+
+
+def project(coords: np.ndarray, zoom: int, center: Coord) -> np.ndarray:
+    '''
+    Projects an array of (lon, lat) coordinates to pixel positions of a
+    SIZE_X x SIZE_Y image centered at center, at the given zoom level.
+
+    Parameters
+    ----------
+    coords: np.ndarray
+        Array of shape (n, 2) with (lon, lat) rows
+    zoom: int
+    center: Coord
+        (lon, lat) of the center of the image
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (n, 2) with (x, y) pixel rows
     '''
-        Given a path p plots it using the citygraph and the orig and dest
-        coordinates and saves it into a file.
+    lat: np.ndarray = np.radians(coords[:, 1])
+    x: np.ndarray = (coords[:, 0] + 180) / 360 * TILE_SIZE * 2**zoom
+    y: np.ndarray = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 \
+        * TILE_SIZE * 2**zoom
+    return np.column_stack((x - lon_to_px(center[0], zoom) + SIZE_X / 2,
+                            y - lat_to_px(center[1], zoom) + SIZE_Y / 2))
+
+
+def fit_zoom(coords: List[Coord]) -> int:
+    '''
+    Returns the highest zoom level at which all the coords (lon, lat) fit in a
+    SIZE_X x SIZE_Y image with PADDING, the same way staticmap chooses it.
+    '''
+    lons: List[float] = [c[0] for c in coords]
+    lats: List[float] = [c[1] for c in coords]
+    for zoom in range(MAX_ZOOM, -1, -1):
+        width: float = lon_to_px(max(lons), zoom) - lon_to_px(min(lons), zoom)
+        height: float = lat_to_px(min(lats), zoom) - \
+            lat_to_px(max(lats), zoom)
+        if width <= SIZE_X - 2*PADDING and height <= SIZE_Y - 2*PADDING:
+            return zoom
+    return 0
+
+
+def simplify(coords: List[Coord], zoom: int,
+             tolerance: float = SIMPLIFY_TOLERANCE) -> List[Coord]:
+    '''
+    Simplifies a polyline with the Douglas-Peucker algorithm. The points are
+    compared in pixels at the given zoom level, so the removed points are the
+    ones which would deviate less than tolerance pixels from the drawn line.
+
+    Parameters
+    ----------
+    coords: List[Coord]
+        Polyline as a list of (lon, lat) coordinates
+    zoom: int
+    tolerance: float
+        Maximum distance in pixels between the original and simplified line
+
+    Returns
+    -------
+    List[Coord]
+        The kept coordinates, always including the first and last ones
+    '''
+    if len(coords) < 3:
+        return coords
+    px: List[Tuple[float, float]] = [(lon_to_px(c[0], zoom),
+                                      lat_to_px(c[1], zoom)) for c in coords]
+    keep: List[bool] = [False] * len(coords)
+    keep[0] = keep[-1] = True
+    stack: List[Tuple[int, int]] = [(0, len(coords) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x0, y0), (x1, y1) = px[first], px[last]
+        dx, dy = x1 - x0, y1 - y0
+        norm: float = (dx*dx + dy*dy) ** 0.5
+        max_dist, index = -1.0, first
+        for i in range(first + 1, last):
+            x, y = px[i]
+            if norm > 0:
+                d = abs(dy*(x - x0) - dx*(y - y0)) / norm
+            else:
+                d = ((x - x0)**2 + (y - y0)**2) ** 0.5
+            if d > max_dist:
+                max_dist, index = d, i
+        if max_dist > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [c for c, k in zip(coords, keep) if k]
+
+
+def route_summary(g: CityGraph, p: Path, orig: Coord,
+                  dest: Coord) -> RouteSummary:
+    '''
+    Walks the path once and summarizes it: totals, legs and the polylines to
+    draw. The walk from orig to the first node is part of the first leg.
+
+    Parameters
+    ----------
+    g: CityGraph
+    p: Path
+    orig: Coord
+    dest: Coord
+
+    Returns
+    -------
+    RouteSummary
+    '''
+    if not p:
+        return RouteSummary(orig, dest, 0, 0)
+    start: Coord = node_pos(g, p[0])  # (lon, lat)
+    dist: float = float(geo.distance(orig[0], orig[1], start[1], start[0]))
+    route: RouteSummary = RouteSummary(
+        orig, dest, dist, dist/WALKING_SPEED,
+        [Leg('walk', dist, dist/WALKING_SPEED)], [],
+        start, node_pos(g, p[-1]))
+
+    for prev_node, node in zip(p, p[1:]):
+        edge = path_edge(g, prev_node, node)
+        kind: str = LEG_KINDS.get(edge['type'], 'walk')
+        leg: Leg = route.legs[-1]
+        if kind != leg.kind or \
+                (kind == 'metro' and edge['line_name'] != leg.line_name):
+            leg = Leg(kind)
+            if kind == 'metro':
+                # The expected wait for the train, as in metro.raptor
+                leg.time += metro.LINE_HEADWAY / 2
+                route.time += metro.LINE_HEADWAY / 2
+                leg.line_name = edge['line_name']
+                leg.direction = edge['line_dest'
+                                     if edge['orientation'] ==
+                                     (prev_node, node) else 'line_orig']
+                leg.start_name = g.nodes[prev_node]['name']
+            route.legs.append(leg)
+        if kind == 'metro':
+            leg.stops += 1
+            leg.end_name = g.nodes[node]['name']
+        leg.distance += edge['distance']
+        leg.time += edge['travel_time']
+        route.distance += edge['distance']
+        route.time += edge['travel_time']
+
+        # We merge consecutive edges of the same color in a polyline
+        color: str = edge_color(edge)
+        if not route.polylines or route.polylines[-1][1] != color:
+            route.polylines.append(([node_pos(g, prev_node)], color))
+        if 'geometry' in edge:
+            route.polylines[-1][0].extend(
+                edge['geometry'] if edge['orientation'][0] == prev_node
+                else edge['geometry'][::-1])
+        route.polylines[-1][0].append(node_pos(g, node))
+    return route
+
+
+def plot_path(route: RouteSummary, filename: str) -> None:
+    '''
+        Plots the path of a route and saves it into a file.
+        Edges with the same color are drawn as a single polyline, simplified
+        at the zoom level of the image.
 
         Parameters
         ----------
-        g: CityGraph
-        p: Path
+        route: RouteSummary
         filename: str
             The filenamen of the saved image
-        orig: Coord
-        dest: Coord
     '''
 
-    map: StaticMap = StaticMap(
+    map: StaticMap = metro.TimedMap(
         SIZE_X, SIZE_Y, padding_x=PADDING, padding_y=PADDING,
         url_template='http://a.tile.osm.org/{z}/{x}/{y}.png')
-    if p:
-        for prev_node, node in zip(p, p[1:]):
-            map.add_line(Line([g.nodes[prev_node]['pos'],
-                               g.nodes[node]['pos']],
-                              edge_color(g, prev_node, node), 6))
-
-        map.add_marker(CircleMarker(g.nodes[p[0]]['pos'], 'blue', 10))
-        map.add_marker(CircleMarker(g.nodes[p[-1]]['pos'], 'red', 10))
+    if route.start is not None and route.end is not None:
+        # The markers can only make staticmap zoom out, so simplifying at
+        # this zoom never removes a visible detail.
+        zoom: int = fit_zoom([route.start, route.end] +
+                             [c for coords, _ in route.polylines
+                              for c in coords])
+        for coords, color in route.polylines:
+            map.add_line(Line(simplify(coords, zoom), color, PATH_WIDTH,
+                              simplify=False))
+
+        map.add_marker(CircleMarker(route.start, 'blue', 10))
+        map.add_marker(CircleMarker(route.end, 'red', 10))
     try:
         image = map.render()
         image.save(filename)
@@ -282,29 +1638,20 @@ def plot_path(g: CityGraph, p: Path, filename: str,
         print("Could not render or save image")
 
 
-def time_dist_txt(g: CityGraph, p: Path, orig: Coord) -> str:
+def time_dist_txt(route: RouteSummary) -> str:
     '''
-        Given a path and a CityGraph calculates the time and distance of the
-        path
+        Given a route returns a text with its time and distance
 
         Parameters
         ----------
-        g: CityGraph
-        p: Path
-        orig: Coord
+        route: RouteSummary
 
         Returns
         -------
         text: str
     '''
-    dist: float = haversine(
-        (orig[1], orig[0]), g.nodes[p[0]]["pos"], unit='m')
-    t: float = dist/WALKING_SPEED
-    for id1, id2 in zip(p, p[1:]):
-        dist += g.edges[(id1, id2)]['distance']
-        t += g.edges[(id1, id2)]['travel_time']
-
-    return f"⏳  Temps total {time_txt(t)}, distància {dist_txt(dist)}"
+    return (f"⏳  Temps total {time_txt(route.time)}, "
+            f"distància {dist_txt(route.distance)}")
 
 
 def time_txt(t: float) -> str:
@@ -347,17 +1694,14 @@ def dist_txt(dist: float) -> str:
     return f"{dist} m" if dist < 1000 else f"{dist//1000} km {dist%1000} m"
 
 
-def path_txt(g: CityGraph, p: Path, orig: Coord, dest: Coord) -> str:
+def path_txt(route: RouteSummary) -> str:
     '''
-        Generates a resumed set of instructions from a Path in form of a
+        Generates a resumed set of instructions from a route in form of a
         text message
 
         Parameters
         ----------
-        g: CityGraph
-        p: Path
-        orig: Coord
-        dest: Coord
+        route: RouteSummary
 
         Returns
         -------
@@ -365,72 +1709,33 @@ def path_txt(g: CityGraph, p: Path, orig: Coord, dest: Coord) -> str:
     '''
     try:
         now: datetime = datetime.now()
-        path_txt: str = f"{time_dist_txt(g, p, orig)}\n🔵 La teva ubicació\n"
-        i: int = 1
-        n: int = len(p)
-        street_types: List[str] = ['street', 'Street', 'access']
-        dist: float = haversine(
-            (orig[1], orig[0]), g.nodes[p[0]]["pos"], unit='m')
-        t: float = 0
-        while i < n:
-            edge = g.edges[p[i-1], p[i]]
-            if edge['type'] in street_types:
-                while edge['type'] in street_types:
-                    dist += edge['distance']
-                    t += edge['travel_time']
-                    i += 1
-                    if i >= n:
-                        break
-                    edge = g.edges[p[i-1], p[i]]
-                # we update the message
+        path_txt: str = f"{time_dist_txt(route)}\n🔵 La teva ubicació\n"
+        legs: List[Leg] = route.legs
+        for i, leg in enumerate(legs):
+            if leg.kind == 'walk':
                 path_txt += (f"🚶‍ {now.strftime('%H:%M')} | "
-                             f"Camina {time_txt(t)} ({dist_txt(dist)})\n")
-                now += timedelta(seconds=t)
-                dist, t = 0, 0
-
-            fst_edge = edge
-            stops: int = 0
-            if edge['type'] == 'line':
-                line_dest = edge['line_dest'
-                                 if edge['orientation'] == (p[i-1], p[i])
-                                 else 'line_orig']
+                             f"Camina {time_txt(leg.time)} "
+                             f"({dist_txt(leg.distance)})\n")
+            elif leg.kind == 'metro':
                 path_txt += (f"Ⓜ️ {now.strftime('%H:%M')} | Agafa la linea "
-                             f"{edge['line_name']} en "
-                             f"{g.nodes[p[i-1]]['name']}, amb direcció "
-                             f"{line_dest}\n")
-                while edge['type'] == 'line':
-                    dist += edge['distance']
-                    t += edge['travel_time']
-                    i += 1
-                    stops += 1
-                    if i >= n:
-                        break
-                    edge = g.edges[p[i-1], p[i]]
-                # we update the message
-                path_txt += (f"🚊 Espera't {stops} parades ({time_txt(t)}) i "
-                             f"baixa't a {g.nodes[p[i-1]]['name']}\n")
-                now += timedelta(seconds=t)
-                dist, t = 0, 0
-
-            if edge['type'] == 'transfer':
-                i += 1
-                edge = g.edges[p[i-1], p[i]]
-                dist += edge['distance']
-                t += edge['travel_time']
-                if fst_edge['type'] == edge['type'] == 'line' and\
-                        fst_edge['line_name'] != edge['line_name']:
-                    path_txt += (f"🔳 {now.strftime('%H:%M')} | Transbord de "
-                                 f"la línia {fst_edge['line_name']} a la "
-                                 f"línia {edge['line_name']}\n")
-                now += timedelta(seconds=edge['travel_time'])
-
-            dist = 0
+                             f"{leg.line_name} en {leg.start_name}, amb "
+                             f"direcció {leg.direction}\n"
+                             f"🚊 Espera't {leg.stops} parades "
+                             f"({time_txt(leg.time)}) i baixa't a "
+                             f"{leg.end_name}\n")
+            elif 0 < i < len(legs) - 1 and \
+                    legs[i-1].kind == legs[i+1].kind == 'metro' and \
+                    legs[i-1].line_name != legs[i+1].line_name:
+                path_txt += (f"🔳 {now.strftime('%H:%M')} | Transbord de "
+                             f"la línia {legs[i-1].line_name} a la "
+                             f"línia {legs[i+1].line_name}\n")
+            now += timedelta(seconds=leg.time)
 
         return path_txt + f"📍 {now.strftime('%H:%M')}"
     except Exception as e:
         print(e)
         print("Could not create elaborate message, returning simple message")
-        return time_dist_txt(g, p, orig)
+        return time_dist_txt(route)
 
 
 def show(g: CityGraph) -> None:
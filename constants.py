@@ -8,8 +8,6 @@ TRANSFER_COLOR = 'orange'
 STREET_COLOR = 'black'
 ACCESS_COLOR = 'grey'
 
-ID_OFFSET = 1000000
-
 
 PADDING = 10
 MAX_L = 1
@@ -18,3 +16,7 @@ INF = 2147483647
 
 SUBWAY_WAITING = 60  # seconds
 TRANSFER_TIME = 30  # seconds
+
+# Whether the city graph keeps only the attributes used once built
+# (see city.strip_graph)
+STRIP_GRAPH: bool = True
@@ -0,0 +1,139 @@
+# IMPORTS
+import numpy as np
+from typing import Tuple, Union
+from typing_extensions import TypeAlias
+
+# Constants
+EARTH_RADIUS: float = 6371008.8  # meters, mean radius
+# Relative error of approx_distance for points less than 50 km apart around
+# the latitude of Barcelona (checked by the benchmark below)
+APPROX_MAX_ERROR: float = 1e-5
+
+Coord: TypeAlias = Tuple[float, float]  # (lat, lon)
+Degrees: TypeAlias = Union[float, np.ndarray]
+
+#   ******************
+#   Geodesic distances
+#   ******************
+
+
+def distance(lat1: Degrees, lon1: Degrees, lat2: Degrees,
+             lon2: Degrees) -> Union[float, np.ndarray]:
+    '''
+    Great circle distance (in meters) with the haversine formula. The
+    arguments can be numbers or numpy arrays, which are broadcast, so any
+    combination of one to one, one to many and pairwise is computed at once.
+
+    Parameters
+    ----------
+    lat1: Degrees
+    lon1: Degrees
+    lat2: Degrees
+    lon2: Degrees
+
+    Returns
+    -------
+    Union[float, np.ndarray]
+    '''
+    phi1: np.ndarray = np.radians(lat1)
+    phi2: np.ndarray = np.radians(lat2)
+    a: np.ndarray = np.sin((phi2 - phi1) / 2)**2 + \
+        np.cos(phi1) * np.cos(phi2) * np.sin(np.radians(lon2 - lon1) / 2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def approx_distance(lat1: Degrees, lon1: Degrees, lat2: Degrees,
+                    lon2: Degrees) -> Union[float, np.ndarray]:
+    '''
+    Equirectangular approximation of distance, cheaper to compute. Within a
+    city its relative error is below APPROX_MAX_ERROR.
+    '''
+    x: np.ndarray = np.radians(lon2 - lon1) * \
+        np.cos(np.radians((lat1 + lat2) / 2))
+    y: np.ndarray = np.radians(lat2 - lat1)
+    return EARTH_RADIUS * np.hypot(x, y)
+
+
+def one_to_many(orig: Coord, coords: np.ndarray,
+                approx: bool = False) -> np.ndarray:
+    '''
+    Returns the distance (in meters) from orig to each point of coords.
+
+    Parameters
+    ----------
+    orig: Coord
+        (lat, lon)
+    coords: np.ndarray
+        Array of shape (n, 2) with the (lat, lon) of each point
+    approx: bool
+        Whether to use approx_distance, False by default
+
+    Returns
+    -------
+    np.ndarray
+    '''
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    dist = approx_distance if approx else distance
+    return dist(orig[0], orig[1], coords[:, 0], coords[:, 1])
+
+
+def pairwise(origs: np.ndarray, dests: np.ndarray,
+             approx: bool = False) -> np.ndarray:
+    '''
+    Returns the distance (in meters) from each point of origs to the point of
+    dests in the same position. Both are arrays of shape (n, 2) of (lat, lon).
+    '''
+    origs = np.asarray(origs, dtype=float).reshape(-1, 2)
+    dests = np.asarray(dests, dtype=float).reshape(-1, 2)
+    dist = approx_distance if approx else distance
+    return dist(origs[:, 0], origs[:, 1], dests[:, 0], dests[:, 1])
+
+
+#   ***************
+#   Micro-benchmark
+#   ***************
+
+
+def _benchmark(n: int = 200000) -> None:
+    '''
+    Compares computing n distances one pair at a time with the vectorized
+    and approximate versions, and checks the error of the approximation on
+    random points around Barcelona.
+    '''
+    import time
+    from math import radians, sin, cos, asin, sqrt
+
+    def scalar(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+        a: float = sin(radians(lat2 - lat1) / 2)**2 + \
+            cos(radians(lat1)) * cos(radians(lat2)) * \
+            sin(radians(lon2 - lon1) / 2)**2
+        return 2 * EARTH_RADIUS * asin(sqrt(a))
+
+    rng = np.random.default_rng(0)
+    origs: np.ndarray = np.column_stack((rng.uniform(41.3, 41.5, n),
+                                         rng.uniform(2.0, 2.3, n)))
+    dests: np.ndarray = np.column_stack((rng.uniform(41.3, 41.5, n),
+                                         rng.uniform(2.0, 2.3, n)))
+
+    t: float = time.perf_counter()
+    loop: np.ndarray = np.array([scalar(a, b, c, d) for (a, b), (c, d) in
+                                 zip(origs.tolist(), dests.tolist())])
+    print('one pair at a time: %.1f ms' % ((time.perf_counter() - t)*1000))
+    t = time.perf_counter()
+    exact: np.ndarray = pairwise(origs, dests)
+    print('pairwise:           %.1f ms' % ((time.perf_counter() - t)*1000))
+    t = time.perf_counter()
+    approx: np.ndarray = pairwise(origs, dests, approx=True)
+    print('pairwise approx:    %.1f ms' % ((time.perf_counter() - t)*1000))
+    t = time.perf_counter()
+    one_to_many(tuple(origs[0]), dests)
+    print('one to many:        %.1f ms' % ((time.perf_counter() - t)*1000))
+
+    assert np.allclose(loop, exact)
+    error: float = float((np.abs(approx - exact) / exact).max())
+    print('approx max relative error: %.2e' % error)
+    assert error < APPROX_MAX_ERROR
+
+
+if __name__ == "__main__":
+    _benchmark()
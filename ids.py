@@ -0,0 +1,71 @@
+# IMPORTS
+import numpy as np
+from dataclasses import dataclass, field
+from typing import List, Tuple, Dict, Iterable
+from typing_extensions import TypeAlias
+
+NodeID: TypeAlias = int  # Dense ids: 0, 1, 2, ...
+Code: TypeAlias = int  # CODI_ESTACIO, CODI_ACCES or osmid
+
+#   *****************
+#   Class definitions
+#   *****************
+
+
+@dataclass
+class IdMap:
+    '''
+    Class used to give dense integer ids to the nodes of the graphs
+    (stations, accesses and street intersections), so that the original codes
+    of each kind of node never collide and node ids can be used directly as
+    positions in arrays.
+
+    Attributes
+    ----------
+    kinds: List[str]
+        Type of node of each id: 'station', 'access' or 'street_intersection'
+    codes: List[Code]
+        Original code of each id
+    index: Dict[Tuple[str, Code], NodeID]
+        Id of each (type of node, code). Some stations of L9 and L10 share
+        their code, in which case it gives the first one.
+    '''
+    kinds: List[str] = field(default_factory=list)
+    codes: List[Code] = field(default_factory=list)
+    index: Dict[Tuple[str, Code], NodeID] = field(default_factory=dict)
+
+
+def new_id(ids: IdMap, kind: str, code: Code) -> NodeID:
+    '''
+    Gives a new id to the node of the given type and code and returns it.
+    A new id is given even if the code is repeated.
+    '''
+    node: NodeID = len(ids.kinds)
+    ids.kinds.append(kind)
+    ids.codes.append(code)
+    ids.index.setdefault((kind, code), node)
+    return node
+
+
+def get_id(ids: IdMap, kind: str, code: Code) -> NodeID:
+    '''Returns the id of the node of the given type and code'''
+    try:
+        return ids.index[kind, code]
+    except KeyError:
+        raise KeyError(f"there is no {kind} with code {code}")
+
+
+def get_ids(ids: IdMap, kind: str, codes: Iterable[Code]) -> np.ndarray:
+    '''Returns the ids of the nodes of the given type and codes'''
+    return np.array([get_id(ids, kind, code) for code in codes],
+                    dtype=np.int64)
+
+
+def get_code(ids: IdMap, node: NodeID) -> Tuple[str, Code]:
+    '''Returns the type of node and original code of an id'''
+    return ids.kinds[node], ids.codes[node]
+
+
+def copy_ids(ids: IdMap) -> IdMap:
+    '''Returns a copy of ids, which can be extended independently'''
+    return IdMap(list(ids.kinds), list(ids.codes), dict(ids.index))
@@ -0,0 +1,362 @@
+# IMPORTS
+import argparse
+import json
+import random
+import resource
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from telegram import Chat, Location, Message, Update, User
+
+import benchmark
+import bot
+import city
+import metro
+import restaurants
+from constants import STRIP_GRAPH
+
+# Constants
+USERS: int = 20
+REQUESTS: int = 20  # per user
+# Relative frequency of each kind of request
+MIX: Dict[str, float] = {'find': 4, 'info': 2, 'guide': 2, 'location': 1}
+# Seconds a user waits between requests (think time), at random up to it
+THINK_TIME: float = 0
+SEED: int = 2022
+
+#   *****************
+#   Class definitions
+#   *****************
+
+
+@dataclass
+class Sent:
+    '''
+    Class used to store a message sent by the FakeBot
+
+    Attributes
+    ----------
+    kind: str
+        'message' or 'photo'
+    chat_id: int
+    text: str
+        Text or caption
+    size: int
+        Bytes of the photo, 0 if it is a url
+    '''
+    kind: str
+    chat_id: int
+    text: str
+    size: int = 0
+
+
+class FakeBot:
+    '''
+    Bot which records the messages instead of sending them to Telegram
+    '''
+
+    def __init__(self) -> None:
+        self.sent: List[Sent] = []
+        self.lock: threading.Lock = threading.Lock()
+
+    def send_message(self, chat_id: int, text: str, **kwargs: Any) -> None:
+        with self.lock:
+            self.sent.append(Sent('message', chat_id, text))
+
+    def send_photo(self, chat_id: int, photo: Any,
+                   caption: Optional[str] = None, **kwargs: Any) -> None:
+        if hasattr(photo, 'read'):
+            photo = photo.read()
+        with self.lock:
+            self.sent.append(Sent('photo', chat_id, caption or '',
+                                  len(photo) if isinstance(photo, bytes)
+                                  else 0))
+
+
+@dataclass
+class FakeContext:
+    '''
+    Class with the attributes of CallbackContext used by the handlers
+
+    Attributes
+    ----------
+    bot: FakeBot
+    user_data: Dict
+        Shared by all the requests of a user, as in the dispatcher
+    args: List[str]
+        Arguments of the command
+    '''
+    bot: FakeBot
+    user_data: Dict = field(default_factory=dict)
+    args: List[str] = field(default_factory=list)
+
+
+#   ******************
+#   Synthetic requests
+#   ******************
+
+
+def make_update(user_id: int, text: Optional[str] = None,
+                location: Optional[Tuple[float, float]] = None) -> Update:
+    '''
+    Returns an Update with a private message of the user, either a text
+    or a (lat, lon) location
+    '''
+    chat: Chat = Chat(user_id, Chat.PRIVATE, first_name=f"User {user_id}")
+    message: Message = Message(
+        user_id, datetime.now(), chat,
+        from_user=User(user_id, f"User {user_id}", False), text=text,
+        location=Location(location[1], location[0]) if location else None)
+    return Update(user_id, message=message)
+
+
+def request(kind: str, user_id: int, rng: random.Random,
+            context: FakeContext) -> Tuple[Callable, Update]:
+    '''
+    Returns the handler of bot and the Update of a random request of the
+    given kind, and sets the arguments of the context
+    '''
+    user: Optional[bot.User] = context.user_data.get('user')
+    results: int = len(user.current_search or []) if user else 0
+    number: str = str(rng.randrange(max(results, 1)))
+    if kind == 'location':
+        context.args = []
+        return bot.update_location, make_update(
+            user_id, location=benchmark.random_point(rng))
+    if kind == 'find':
+        query: str = rng.choice(benchmark.FIND_QUERIES)
+        context.args = query.split()
+        return bot.find, make_update(user_id, text=f"/find {query}")
+    context.args = [number]
+    handler: Callable = bot.info if kind == 'info' else bot.guide
+    return handler, make_update(user_id, text=f"/{kind} {number}")
+
+
+def simulate_user(user_id: int, requests: int, mix: Dict[str, float],
+                  think_time: float,
+                  fake_bot: FakeBot) -> List[Tuple[str, float]]:
+    '''
+    Simulates a user which shares a location, searches and then makes
+    random requests, one after the other. Returns the kind and latency
+    (seconds) of each request.
+    '''
+    rng: random.Random = random.Random(SEED + user_id)
+    context: FakeContext = FakeContext(fake_bot)
+    kinds: List[str] = ['location', 'find'] + rng.choices(
+        list(mix), weights=list(mix.values()), k=max(requests - 2, 0))
+    latencies: List[Tuple[str, float]] = []
+    for kind in kinds[:requests]:
+        handler, update = request(kind, user_id, rng, context)
+        start: float = time.perf_counter()
+        handler(update, context)
+        latencies.append((kind, time.perf_counter() - start))
+        if think_time:
+            time.sleep(rng.uniform(0, think_time))
+    return latencies
+
+
+#   *****
+#   Setup
+#   *****
+
+
+def setup(osmnx: bool = False, limits: bool = True,
+          strip: bool = STRIP_GRAPH) -> None:
+    '''
+    Builds the graphs and restaurants and sets them as the globals of bot,
+    as its initialization does.
+
+    Parameters
+    ----------
+    osmnx: bool
+        Whether to use the street graph of Barcelona (downloaded or read from
+        city.PICKLE_FILENAME) instead of the synthetic one of benchmark
+    limits: bool
+        Whether to keep the admission control and user rate limits
+    strip: bool
+        Whether to strip the city graph (see city.strip_graph)
+    '''
+    bot.metro_graph = metro.get_metro_graph()
+    bot.city_osmnx = city.get_osmnx_graph() if osmnx else \
+        benchmark.street_grid()
+    bot.city_graph = city.build_city_graph(bot.city_osmnx, bot.metro_graph)
+    if strip:
+        city.strip_graph(bot.city_graph)
+    if osmnx:
+        city.get_landmarks(bot.city_graph)
+    else:
+        bot.city_graph.graph["landmarks"] = city.build_landmarks(
+            bot.city_graph)
+    index: restaurants.RestaurantIndex = restaurants.read_index()
+    bot.metro_links = city.build_metro_links(bot.city_graph)
+    access: city.AccessTable = city.build_access_table(
+        bot.city_graph,
+        city.snap_restaurants(bot.city_osmnx, bot.city_graph, index.rsts))
+    bot.rest_data = bot.RestaurantData(
+        index, access, restaurants.build_completions(index.rsts), 0)
+    with open('help_msg.txt', 'r') as msg:
+        bot.help_txt = {line.split()[0][1:].replace(':', ''): line
+                        for line in msg}
+    if not limits:
+        for adm in bot.admissions.values():
+            adm.limit = adm.queue = 10**6
+        bot.USER_RATE = bot.USER_BURST = 10**6
+
+
+@contextmanager
+def no_yelp() -> Iterator[None]:
+    '''
+    Context manager which makes /info get no extra information instead of
+    asking Yelp
+    '''
+    get_yelp_info: Callable = restaurants.get_yelp_info
+    restaurants.get_yelp_info = lambda rst: None
+    try:
+        yield
+    finally:
+        restaurants.get_yelp_info = get_yelp_info
+
+
+#   *********
+#   Load test
+#   *********
+
+
+def run(users: int = USERS, requests: int = REQUESTS,
+        mix: Dict[str, float] = MIX, think_time: float = THINK_TIME,
+        yelp: bool = False, trace: bool = False) -> Dict[str, Any]:
+    '''
+    Runs the load test, once setup has been called: users simulated users
+    (see simulate_user) make requests at the same time, each in a thread.
+    Map tiles are not downloaded.
+
+    Parameters
+    ----------
+    users: int
+    requests: int
+        Requests of each user
+    mix: Dict[str, float]
+        Relative frequency of each kind of request
+    think_time: float
+    yelp: bool
+        Whether /info asks Yelp, otherwise it gets no extra information
+    trace: bool
+        Whether to measure the peak of Python memory with tracemalloc,
+        which makes everything slower
+
+    Returns
+    -------
+    Dict[str, Any]
+        Throughput, latency percentiles (ms) overall and by kind, peak
+        memory and what was sent
+    '''
+    fake_bot: FakeBot = FakeBot()
+    # Peak RSS once the graphs are built, ru_maxrss is in KB
+    baseline: float = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if trace:
+        tracemalloc.start()
+    start: float = time.perf_counter()
+    with benchmark.no_tiles(), nullcontext() if yelp else no_yelp(), \
+            ThreadPoolExecutor(users) as pool:
+        done: List[List[Tuple[str, float]]] = list(pool.map(
+            lambda i: simulate_user(i + 1, requests, mix, think_time,
+                                    fake_bot), range(users)))
+    elapsed: float = time.perf_counter() - start
+    peak_rss: float = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak: Optional[int] = None
+    if trace:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    by_kind: Dict[str, List[float]] = defaultdict(list)
+    for kind, latency in (item for user in done for item in user):
+        by_kind[kind].append(latency)
+    every: List[float] = [t for times in by_kind.values() for t in times]
+    sent: Dict[str, int] = defaultdict(int)
+    for message in fake_bot.sent:
+        sent[message.kind] += 1
+        if message.text.startswith('Commanda incorrecte'):
+            sent['errors'] += 1
+    return {
+        "users": users, "requests": len(every), "seconds": elapsed,
+        "throughput": len(every) / elapsed,
+        "latency": latency_summary(every),
+        "by_kind": {kind: latency_summary(times)
+                    for kind, times in sorted(by_kind.items())},
+        # Of the whole process, including the graphs, and its growth
+        # during the requests
+        "peak_rss_mb": peak_rss / 1024,
+        "rss_growth_mb": (peak_rss - baseline) / 1024,
+        "peak_traced_mb": peak / 2**20 if peak is not None else None,
+        "sent": dict(sent), "admission": bot.admission_stats()}
+
+
+def latency_summary(times: List[float]) -> Dict[str, float]:
+    '''Returns the count and the p50, p95 and p99 (ms) of the latencies'''
+    values: np.ndarray = np.array(times) * 1000
+    return {"n": len(times), "p50": float(np.percentile(values, 50)),
+            "p95": float(np.percentile(values, 95)),
+            "p99": float(np.percentile(values, 99))}
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    '''Parses a mix of requests written as "find=4,guide=1"'''
+    mix: Dict[str, float] = {}
+    for item in text.split(','):
+        kind, weight = item.split('=')
+        if kind not in MIX:
+            raise ValueError(f"unknown kind of request: {kind}")
+        mix[kind] = float(weight)
+    return mix
+
+
+def main() -> None:
+    '''
+    Runs the load test with the options of the command line and prints (and
+    optionally saves) the results
+    '''
+    parser = argparse.ArgumentParser(description=(
+        "Load test of the bot handlers with simulated users"))
+    parser.add_argument("-u", "--users", type=int, default=USERS,
+                        help="concurrent simulated users")
+    parser.add_argument("-r", "--requests", type=int, default=REQUESTS,
+                        help="requests of each user")
+    parser.add_argument("-m", "--mix", type=parse_mix, default=MIX,
+                        help="frequency of each request, e.g. "
+                        "find=4,info=2,guide=2,location=1")
+    parser.add_argument("-t", "--think-time", type=float, default=THINK_TIME,
+                        help="maximum seconds between requests of a user")
+    parser.add_argument("--osmnx", action="store_true",
+                        help="use the street graph of Barcelona")
+    parser.add_argument("--yelp", action="store_true",
+                        help="let /info ask Yelp")
+    parser.add_argument("--no-limits", action="store_true",
+                        help="disable admission control and rate limits")
+    parser.add_argument("--no-strip", action="store_true",
+                        help="keep every attribute of the city graph")
+    parser.add_argument("--trace", action="store_true",
+                        help="measure peak Python memory (slower)")
+    parser.add_argument("-o", "--output",
+                        help="JSON file where the results are saved")
+    args = parser.parse_args()
+
+    setup(args.osmnx, not args.no_limits, not args.no_strip)
+    results: Dict[str, Any] = run(args.users, args.requests, args.mix,
+                                  args.think_time, args.yelp, args.trace)
+    bot.speculator.shutdown(cancel_futures=True)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# IMPORTS
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Tuple
+
+# Constants
+METRICS_PORT: int = 9464
+# Upper bounds (seconds) of the buckets of the latency histograms
+BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                              2.5, 5, 10, 30)
+PREFIX: str = "nyam"
+
+logger: logging.Logger = logging.getLogger("metrics")
+
+#   *****************
+#   Class definitions
+#   *****************
+
+
+@dataclass
+class Histogram:
+    '''
+    Class used to store the latencies of a stage
+
+    Attributes
+    ----------
+    counts: List[int]
+        Latencies in each bucket of BUCKETS (not cumulative), and above them
+    total: float
+        Sum of the latencies, in seconds
+    '''
+    counts: List[int] = field(default_factory=lambda: [0] * (len(BUCKETS)+1))
+    total: float = 0
+
+
+# Histogram of each stage
+histograms: Dict[str, Histogram] = {}
+histograms_lock: threading.Lock = threading.Lock()
+# Functions which return more lines for the exposition (see add_collector)
+collectors: List[Callable[[], List[str]]] = []
+
+#   ***********
+#   Measurement
+#   ***********
+
+
+def observe(stage: str, seconds: float) -> None:
+    '''
+    Adds the latency of a stage to its histogram and logs it as
+    "stage=<stage> seconds=<seconds>"
+    '''
+    bucket: int = next((i for i, bound in enumerate(BUCKETS)
+                        if seconds <= bound), len(BUCKETS))
+    with histograms_lock:
+        hist: Histogram = histograms.setdefault(stage, Histogram())
+        hist.counts[bucket] += 1
+        hist.total += seconds
+    logger.info("stage=%s seconds=%.6f", stage, seconds)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    '''
+    Context manager which measures the time spent in its block as a latency
+    of stage (see observe), even if it raises an exception. It can also be
+    used as a decorator of a function.
+    '''
+    start: float = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+#   **********
+#   Exposition
+#   **********
+
+
+def add_collector(collector: Callable[[], List[str]]) -> None:
+    '''
+    Adds a function which returns lines in Prometheus text format, to be
+    added to the exposition
+    '''
+    collectors.append(collector)
+
+
+def exposition() -> str:
+    '''
+    Returns the latency histograms (and the lines of the collectors) in the
+    Prometheus text exposition format
+    '''
+    name: str = f"{PREFIX}_stage_seconds"
+    lines: List[str] = [f"# HELP {name} Latency of each stage of the bot",
+                        f"# TYPE {name} histogram"]
+    with histograms_lock:
+        stages: List[Tuple[str, Histogram]] = [
+            (stage, Histogram(list(hist.counts), hist.total))
+            for stage, hist in sorted(histograms.items())]
+    for stage, hist in stages:
+        cumulative: int = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), hist.counts):
+            cumulative += count
+            le: str = "+Inf" if bound == float('inf') else f"{bound:g}"
+            lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} '
+                         f'{cumulative}')
+        lines.append(f'{name}_sum{{stage="{stage}"}} {hist.total:.6f}')
+        lines.append(f'{name}_count{{stage="{stage}"}} {cumulative}')
+    for collector in collectors:
+        lines += collector()
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    '''
+    Answers GET /metrics with the exposition
+    '''
+
+    def do_GET(self) -> None:
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body: bytes = exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass  # scrapes are not logged
+
+
+def serve(port: int = METRICS_PORT,
+          host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    '''
+    Serves the exposition at http://host:port/metrics from a background
+    thread, and returns the server
+    '''
+    server: ThreadingHTTPServer = ThreadingHTTPServer((host, port),
+                                                      MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True,
+                     name="metrics").start()
+    return server
@@ -1,12 +1,16 @@
 # IMPORTS
 import pandas as pd
 import networkx as nx
+import numpy as np
 from staticmap import StaticMap, CircleMarker, Line
 import matplotlib.pyplot as plt
 from dataclasses import dataclass
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Optional
 from typing_extensions import TypeAlias
-from haversine import haversine
+
+import ids
+import geo
+import metrics
 
 
 # Constants
@@ -18,10 +22,14 @@ WALKING_SPEED: float = 1.42  # m/s
 SUBWAY_SPEED: float = 7.22222222  # m/s
 SUBWAY_WAITING: float = 60  # seconds
 TRANSFER_TIME: float = 30  # seconds
+WEIGHTS: Tuple[str, str] = ('travel_time', 'acc_travel_time')
+# Time between two trains of a line, the mean wait is SUBWAY_WAITING
+LINE_HEADWAY: float = 2 * SUBWAY_WAITING  # seconds
+MAX_ROUNDS: int = 5
 
 Coord: TypeAlias = Tuple[float, float]
 MetroGraph: TypeAlias = nx.Graph
-NodeID: TypeAlias = int  # We use integers as ids
+NodeID: TypeAlias = ids.NodeID  # Dense ids, see ids.IdMap
 
 #   *****************
 #   Class definitions
@@ -91,6 +99,81 @@ class Access:
     position: Coord
 
 
+@dataclass
+class StationMatrix:
+    '''
+    Class used to store the travel time between every pair of stations and
+    the next station in the shortest path between them, for each weight in
+    WEIGHTS (first index 0 for travel_time and 1 for acc_travel_time).
+
+    Attributes
+    ----------
+    ids: np.ndarray
+        Node id of each station
+    index: Dict[NodeID, int]
+        Position of each station node id in ids
+    times: np.ndarray
+        float32 array of shape (2, n, n), times[w, i, j] is the travel time
+        from station i to station j (inf if it is unreachable)
+    next_hop: np.ndarray
+        int16 array of shape (2, n, n), next_hop[w, i, j] is the index of the
+        station after i in the shortest path to j (-1 if it is unreachable)
+    '''
+    ids: np.ndarray
+    index: Dict[NodeID, int]
+    times: np.ndarray
+    next_hop: np.ndarray
+
+
+@dataclass
+class Timetable:
+    '''
+    Class used to store the metro lines as arrays for the RAPTOR router.
+    Each line is stored as two routes, one for each direction. Trains are
+    not scheduled: boarding a route costs the expected wait, half its
+    headway.
+
+    Attributes
+    ----------
+    ids: np.ndarray
+        Node id of each station
+    index: Dict[NodeID, int]
+        Position of each station node id in ids
+    names: List[str]
+        Line name of each route
+    routes: List[np.ndarray]
+        Stations (positions in ids) of each route, in order
+    offsets: List[np.ndarray]
+        Riding time from the first station of each route to each station
+    headways: np.ndarray
+        Time between two trains of each route
+    station_routes: List[List[Tuple[int, int]]]
+        Routes through each station, with the position of the station
+    footpaths: List[List[Tuple[int, float, float]]]
+        Transfers from each station: station, travel_time and
+        acc_travel_time
+    '''
+    ids: np.ndarray
+    index: Dict[NodeID, int]
+    names: List[str]
+    routes: List[np.ndarray]
+    offsets: List[np.ndarray]
+    headways: np.ndarray
+    station_routes: List[List[Tuple[int, int]]]
+    footpaths: List[List[Tuple[int, float, float]]]
+
+
+class TimedMap(StaticMap):
+    '''
+    StaticMap which measures the time spent downloading the tiles as the
+    'tiles' stage (see metrics)
+    '''
+
+    def _draw_base_layer(self, image) -> None:
+        with metrics.timed('tiles'):
+            super()._draw_base_layer(image)
+
+
 Stations: TypeAlias = List[Station]
 Accesses: TypeAlias = List[Access]
 
@@ -222,8 +305,10 @@ def line_distance(g: MetroGraph, orig_id: NodeID, dest_id: NodeID) -> float:
         float
             Distance between orig_id and dest_id in g.
     '''
-    return haversine(g.nodes[orig_id]["pos"],
-                     g.nodes[dest_id]["pos"], unit="m")
+    orig: Coord = g.nodes[orig_id]["pos"]
+    dest: Coord = g.nodes[dest_id]["pos"]
+    # pos is (lon, lat)
+    return float(geo.distance(orig[1], orig[0], dest[1], dest[0]))
 
 
 def accessible_time(Metro: MetroGraph, orig_id: NodeID, dest_id: NodeID,
@@ -259,6 +344,8 @@ def get_metro_graph() -> MetroGraph:
     -Subway lines are represented as edges between contiguous stations
      in the line.
     -Stations of the same group but different line are connected by an edge.
+    The stations of each line, in order, are stored in the graph attribute
+    "lines", and the ids.IdMap of the nodes in "ids".
 
     Returns
     -------
@@ -278,22 +365,22 @@ def get_metro_graph() -> MetroGraph:
     # In order to connect subway lines we take adavantadge of the fact that
     # they are stored in order
     # We add the first station of the list before iterating through the rest
+    # Node ids are given by an IdMap, as station codes are not unique
+    metro_ids: ids.IdMap = ids.IdMap()
     s1: Station = station_list[0]
-    prev_id: NodeID = s1.id
+    prev_id: NodeID = ids.new_id(metro_ids, "station", s1.id)
     prev_line: NodeID = s1.line_id
-    Metro.add_node(s1.id, pos=s1.position, type="station", name=s1.name,
+    Metro.add_node(prev_id, pos=s1.position, type="station", name=s1.name,
                    accessibility=s1.accessibility, line=s1.line_id,
                    line_name=s1.line_name, line_dest=s1.line_dest)
-    line_transfers[s1.group_code] = [s1.id]
+    line_transfers[s1.group_code] = [prev_id]
+    # We also keep the stations of each line in order
+    lines: Dict[str, List[NodeID]] = {s1.line_name: [prev_id]}
     distance: float
     for station in station_list[1:]:
-        # We create the station node
-        # If an station with the same id has previously been added, we still
-        # add the new station but with the id being negative
-        # This happens with some stations in lines L9, L10.
-        id: NodeID = station.id
-        if Metro.has_node(id):
-            id = -id
+        # We create the station node. Some stations in lines L9 and L10 share
+        # their code, but get a different id.
+        id: NodeID = ids.new_id(metro_ids, "station", station.id)
         Metro.add_node(id, pos=station.position, type="station",
                        name=station.name, accessibility=station.accessibility,
                        line=station.line_id, line_name=station.line_name,)
@@ -310,6 +397,7 @@ def get_metro_graph() -> MetroGraph:
                            travel_time=distance/SUBWAY_SPEED,
                            acc_travel_time=distance/SUBWAY_SPEED)
         prev_id, prev_line = id, station.line_id
+        lines.setdefault(station.line_name, []).append(id)
 
         # If we have previously read a station in the same group we append
         # the current station id to the list of transfers.
@@ -322,16 +410,18 @@ def get_metro_graph() -> MetroGraph:
     # We add the nodes corresponding to the accesses and connect each access
     # with its station
     for access in access_list:
-        Metro.add_node(access.code, pos=access.position,
+        access_id: NodeID = ids.new_id(metro_ids, "access", access.code)
+        station_id: NodeID = ids.get_id(metro_ids, "station",
+                                        access.station_id)
+        Metro.add_node(access_id, pos=access.position,
                        station=access.station_name,
                        accessibility=access.accessibility, type="access")
-        distance = line_distance(
-            Metro, access.code, access.station_id)
+        distance = line_distance(Metro, access_id, station_id)
 
-        Metro.add_edge(access.code, access.station_id, type="access",
+        Metro.add_edge(access_id, station_id, type="access",
                        distance=distance, travel_time=distance/WALKING_SPEED,
-                       acc_travel_time=accessible_time(Metro, access.code,
-                                                       access.station_id,
+                       acc_travel_time=accessible_time(Metro, access_id,
+                                                       station_id,
                                                        distance))
 
     # We connect stations which are in the same station group but are of
@@ -350,8 +440,308 @@ def get_metro_graph() -> MetroGraph:
                         acc_travel_time=accessible_time(
                             Metro, i1, i2, distance) + TRANSFER_TIME)
 
+    Metro.graph["lines"] = lines
+    Metro.graph["ids"] = metro_ids
     return Metro
 
+#   ***************************
+#   Station to station matrices
+#   ***************************
+
+
+def get_station_matrix(g: MetroGraph,
+                       nodes: Optional[List[NodeID]] = None) -> StationMatrix:
+    '''
+    Computes the travel time and next hop between every pair of stations of
+    g, for both weights, with the Floyd-Warshall algorithm over the graph
+    induced by the stations (accesses are leaves and never in between).
+
+    Parameters
+    ----------
+    g: MetroGraph
+    nodes: Optional[List[NodeID]]
+        Nodes to use instead of the stations
+
+    Returns
+    -------
+    StationMatrix
+    '''
+    ids: List[NodeID] = nodes if nodes is not None else \
+        [node for node, node_type in g.nodes(data="type")
+         if node_type == "station"]
+    index: Dict[NodeID, int] = {node: i for i, node in enumerate(ids)}
+    n: int = len(ids)
+    times: np.ndarray = np.empty((len(WEIGHTS), n, n), dtype=np.float32)
+    next_hop: np.ndarray = np.empty((len(WEIGHTS), n, n), dtype=np.int16)
+
+    for w, weight in enumerate(WEIGHTS):
+        dist: np.ndarray = np.full((n, n), np.inf)
+        nxt: np.ndarray = np.full((n, n), -1, dtype=np.int64)
+        np.fill_diagonal(dist, 0)
+        np.fill_diagonal(nxt, np.arange(n))
+        for u, v, value in g.subgraph(ids).edges(data=weight):
+            i, j = index[u], index[v]
+            if value < dist[i, j]:
+                dist[i, j] = dist[j, i] = value
+                nxt[i, j], nxt[j, i] = j, i
+        for k in range(n):
+            through_k: np.ndarray = dist[:, k, None] + dist[None, k, :]
+            better: np.ndarray = through_k < dist
+            dist = np.where(better, through_k, dist)
+            nxt = np.where(better, nxt[:, k, None], nxt)
+        times[w], next_hop[w] = dist, nxt
+
+    return StationMatrix(np.array(ids, dtype=np.int64), index, times,
+                         next_hop)
+
+
+def station_time(m: StationMatrix, orig_id: NodeID, dest_id: NodeID,
+                 accessibility: bool = False) -> float:
+    '''
+    Returns the travel time between two stations (inf if there is no path).
+
+    Parameters
+    ----------
+    m: StationMatrix
+    orig_id: NodeID
+    dest_id: NodeID
+    accessibility: bool
+        Whether to use acc_travel_time, False by default
+
+    Returns
+    -------
+    float
+    '''
+    return float(m.times[int(accessibility), m.index[orig_id],
+                         m.index[dest_id]])
+
+
+def station_path(m: StationMatrix, orig_id: NodeID, dest_id: NodeID,
+                 accessibility: bool = False) -> List[NodeID]:
+    '''
+    Returns the stations in the shortest path between two stations, both
+    included, or an empty list if there is no path.
+
+    Parameters
+    ----------
+    m: StationMatrix
+    orig_id: NodeID
+    dest_id: NodeID
+    accessibility: bool
+        Whether to use acc_travel_time, False by default
+
+    Returns
+    -------
+    List[NodeID]
+    '''
+    next_hop: np.ndarray = m.next_hop[int(accessibility)]
+    i: int = m.index[orig_id]
+    j: int = m.index[dest_id]
+    if next_hop[i, j] < 0:
+        return []
+    path: List[NodeID] = [int(m.ids[i])]
+    while i != j:
+        i = int(next_hop[i, j])
+        path.append(int(m.ids[i]))
+    return path
+
+#   ********************
+#   RAPTOR transit router
+#   ********************
+
+
+def build_timetable(g: MetroGraph,
+                    headways: Optional[Dict[str, float]] = None) -> Timetable:
+    '''
+    Builds the Timetable of the lines stored in g (see get_metro_graph).
+
+    Parameters
+    ----------
+    g: MetroGraph
+    headways: Optional[Dict[str, float]]
+        Time between trains of each line name, LINE_HEADWAY by default
+
+    Returns
+    -------
+    Timetable
+    '''
+    ids: List[NodeID] = [node for node, node_type in g.nodes(data="type")
+                         if node_type == "station"]
+    index: Dict[NodeID, int] = {node: i for i, node in enumerate(ids)}
+    names: List[str] = []
+    routes: List[np.ndarray] = []
+    offsets: List[np.ndarray] = []
+    route_headways: List[float] = []
+    station_routes: List[List[Tuple[int, int]]] = [[] for _ in ids]
+    for name, stations in g.graph["lines"].items():
+        for direction in (stations, stations[::-1]):
+            times: List[float] = [0]
+            for u, v in zip(direction, direction[1:]):
+                times.append(times[-1] + g.edges[u, v]["travel_time"])
+            for i, station in enumerate(direction):
+                station_routes[index[station]].append((len(routes), i))
+            names.append(name)
+            routes.append(np.array([index[s] for s in direction]))
+            offsets.append(np.array(times))
+            route_headways.append(LINE_HEADWAY if headways is None
+                                  else headways.get(name, LINE_HEADWAY))
+
+    footpaths: List[List[Tuple[int, float, float]]] = [[] for _ in ids]
+    for u, v, edge in g.edges(data=True):
+        if edge["type"] == "transfer":
+            footpaths[index[u]].append((index[v], edge["travel_time"],
+                                        edge["acc_travel_time"]))
+            footpaths[index[v]].append((index[u], edge["travel_time"],
+                                        edge["acc_travel_time"]))
+
+    return Timetable(np.array(ids, dtype=np.int64), index, names, routes,
+                     offsets, np.array(route_headways), station_routes,
+                     footpaths)
+
+
+def raptor(tt: Timetable, sources: Dict[NodeID, float],
+           accessibility: bool = False, max_rounds: int = MAX_ROUNDS) \
+        -> Tuple[np.ndarray, List[Dict[int, Tuple[int, int, int]]]]:
+    '''
+    Round based earliest arrival search (RAPTOR). Round k finds the best
+    arrival time at every station using k trains: every route through a
+    station improved in the previous round is scanned once, and then
+    transfers are relaxed. Each boarding costs the expected wait for a
+    train, half the headway of the route (SUBWAY_WAITING by default).
+
+    Parameters
+    ----------
+    tt: Timetable
+    sources: Dict[NodeID, float]
+        Time (s) at which each source station is reached
+    accessibility: bool
+        Whether to use acc_travel_time for the transfers, False by default
+    max_rounds: int
+        Maximum number of trains
+
+    Returns
+    -------
+    np.ndarray
+        Earliest arrival time at each station, inf if it is not reached
+    List[Dict[int, Tuple[int, int, int]]]
+        For each round, how each improved station was reached: a route with
+        its boarding and leaving positions, or a transfer (-1, station, -1)
+    '''
+    n: int = len(tt.ids)
+    best: np.ndarray = np.full(n, np.inf)
+    prev: np.ndarray = np.full(n, np.inf)
+    parents: List[Dict[int, Tuple[int, int, int]]] = []
+    marked: List[int] = []
+    for node, t in sources.items():
+        prev[tt.index[node]] = best[tt.index[node]] = t
+        marked.append(tt.index[node])
+
+    for k in range(max_rounds + 1):
+        current: np.ndarray = prev.copy()
+        parent: Dict[int, Tuple[int, int, int]] = {}
+        parents.append(parent)
+        improved: List[int] = marked if k == 0 else []
+        if k > 0:
+            # Routes to scan, from their first improved station
+            queue: Dict[int, int] = {}
+            for p in marked:
+                for r, i in tt.station_routes[p]:
+                    queue[r] = min(queue.get(r, i), i)
+            for r, first in queue.items():
+                stops: np.ndarray = tt.routes[r][first:]
+                offset: np.ndarray = tt.offsets[r][first:]
+                # Time at the first station of a train boarded at each
+                # station, after the wait, and the best one so far
+                board: np.ndarray = prev[stops] + tt.headways[r] / 2 - offset
+                riding: np.ndarray = np.minimum.accumulate(board)
+                boarded: np.ndarray = np.maximum.accumulate(np.where(
+                    board <= np.concatenate(([np.inf], riding[:-1])),
+                    np.arange(len(stops)), 0))
+                arrival: np.ndarray = riding + offset
+                for i in np.flatnonzero(arrival < best[stops]).tolist():
+                    s: int = int(stops[i])
+                    current[s] = best[s] = arrival[i]
+                    parent[s] = (r, first + int(boarded[i]), first + i)
+                    improved.append(s)
+        # Transfers from the stations improved by a train
+        marked = list(improved)
+        for p in improved:
+            for q, travel_time, acc_time in tt.footpaths[p]:
+                t = current[p] + (acc_time if accessibility else travel_time)
+                if t < best[q]:
+                    current[q] = best[q] = t
+                    parent[q] = (-1, p, -1)
+                    marked.append(q)
+        if not marked:
+            break
+        prev = current
+    return best, parents
+
+
+def metro_route(tt: Timetable, orig_id: NodeID, dest_id: NodeID,
+                departure: float = 0, accessibility: bool = False) \
+        -> Tuple[float, List[NodeID]]:
+    '''
+    Finds the earliest arrival route between two stations with RAPTOR,
+    taking into account the expected wait for each train and the transfers.
+
+    Parameters
+    ----------
+    tt: Timetable
+    orig_id: NodeID
+    dest_id: NodeID
+    departure: float
+        Time (s) at the origin station, 0 to get the travel time
+    accessibility: bool
+        False by default
+
+    Returns
+    -------
+    float
+        Arrival time at dest_id, inf if it can not be reached
+    List[NodeID]
+        Stations of the route (every stop included), empty if there is none
+    '''
+    best, parents = raptor(tt, {orig_id: departure}, accessibility)
+    s: int = tt.index[dest_id]
+    if best[s] == np.inf:
+        return float('inf'), []
+    # Each station is reached as stored in the last round that improved it
+    k: int = len(parents) - 1
+    path: List[int] = [s]
+    while s != tt.index[orig_id]:
+        k = max(j for j in range(k + 1) if s in parents[j])
+        r, board, leave = parents[k][s]
+        if r < 0:
+            s = board
+            path.append(s)
+        else:
+            path += tt.routes[r][board:leave][::-1].tolist()
+            s = int(tt.routes[r][board])
+            k -= 1
+    return float(best[tt.index[dest_id]]), \
+        [int(tt.ids[i]) for i in path[::-1]]
+
+
+def ride_times(tt: Timetable, accessibility: bool = False) -> np.ndarray:
+    '''
+    Returns the travel time between every pair of stations of tt (in the
+    order of tt.ids) riding the metro, with the expected waits and the
+    transfers (see raptor), inf if there is no route.
+
+    Parameters
+    ----------
+    tt: Timetable
+    accessibility: bool
+        False by default
+
+    Returns
+    -------
+    np.ndarray
+    '''
+    return np.array([raptor(tt, {node: 0}, accessibility)[0]
+                     for node in tt.ids.tolist()])
+
 #   ********************
 #   Plotting and showing
 #   ********************
@@ -370,7 +760,7 @@ def plot(g: MetroGraph, filename: str) -> None:
         name of the file we create
     '''
 
-    map: StaticMap = StaticMap(
+    map: StaticMap = TimedMap(
         SIZE_X, SIZE_Y,
         url_template='http://a.tile.osm.org/{z}/{x}/{y}.png')
     for pos in nx.get_node_attributes(g, "pos").values():
@@ -1,18 +1,46 @@
 import json
 from dataclasses import dataclass
-from typing import Optional, List, Tuple, Dict, Union, Set
+from typing import Optional, List, Tuple, Dict, Union, Set, Iterator
 import math
+import heapq
+import bisect
+import numpy as np
 import requests
 from typing_extensions import TypeAlias
 import re
-from fuzzysearch import find_near_matches
 import pandas as pd
 
+import geo
+import metrics
 
 # Constants
 RESTAURANT_FILE = "restaurants.csv"
 MAX_L = 1
 MAX_DEL = 1
+CELL_SIZE: float = 250  # meters, side of the cells of the RestaurantIndex
+MATCH_PENALTY: float = 500  # meters added to the score for each edit
+TOP_K: int = 12
+MAX_COMPLETIONS: int = 10
+# Latitude up to which the cells of a RestaurantIndex are CELL_SIZE meters
+# wide, if it is built in chunks (Spain is south of 43.8)
+MAX_LAT: float = 44.0
+CHUNK_SIZE: int = 10000
+# Columns of RESTAURANT_FILE used to create restaurants, with their types
+DTYPES: Dict[str, type] = {
+    'register_id': str, 'name': str, 'addresses_road_id': float,
+    'addresses_road_name': str, 'addresses_start_street_number': float,
+    'addresses_end_street_number': float, 'addresses_neighborhood_id': float,
+    'addresses_neighborhood_name': str, 'addresses_district_id': float,
+    'addresses_district_name': str, 'addresses_zip_code': float,
+    'values_value': str, 'geo_epgs_4326_x': float, 'geo_epgs_4326_y': float}
+# Used by normalize_str
+NORMALIZE_TABLE: Dict[int, str] = str.maketrans({
+    'à': 'a', 'á': 'a', 'ä': 'a',
+    'è': 'e', 'é': 'e', 'ë': 'e',
+    'í': 'i', 'ï': 'i',
+    'ò': 'o', 'ó': 'o', 'ö': 'o',
+    'ú': 'u', 'ü': 'u',
+})
 
 Coord: TypeAlias = Tuple[float, float]
 
@@ -99,6 +127,88 @@ class Restaurant:
 Restaurants: TypeAlias = List[Restaurant]
 
 
+@dataclass
+class Pattern:
+    '''
+    Class used to store a search term compiled for approximate matching
+    (see compile_pattern)
+
+    Attributes
+    ----------
+    term: str
+    k: int
+        Maximum number of edits (Levenshtein distance)
+    pieces: List[str]
+        k+1 disjoint parts of term, one of them is in any match
+    peq: Dict[str, int]
+        Bit mask of the positions of each character in term
+    last: int
+        Bit mask of the last position of term
+    '''
+    term: str
+    k: int
+    pieces: List[str]
+    peq: Dict[str, int]
+    last: int
+
+
+# A query parsed by parse_query: ('and', q1, q2), ('or', q1, q2), ('not', q)
+# or ('words', [Pattern, ...])
+Query: TypeAlias = tuple
+
+
+@dataclass
+class RestaurantIndex:
+    '''
+    Class used to rank search results by proximity without looking at every
+    restaurant: restaurants are stored in square cells of CELL_SIZE meters.
+    It can be built incrementally with add_to_index.
+
+    Attributes
+    ----------
+    rsts: Restaurants
+    rows: Dict[int, int]
+        Position in rsts of each restaurant id
+    coords: np.ndarray
+        (lat, lon) of each restaurant
+    fields: List[Tuple[str, ...]]
+        Normalized fields (see is_interesting) of each restaurant
+    step: Tuple[float, float]
+        Size of the cells in degrees of latitude and longitude, at least
+        CELL_SIZE meters in both directions
+    cells: Dict[Tuple[int, int], List[int]]
+        Positions in rsts of the restaurants in each cell
+    '''
+    rsts: Restaurants
+    rows: Dict[int, int]
+    coords: np.ndarray
+    fields: List[Tuple[str, ...]]
+    step: Tuple[float, float]
+    cells: Dict[Tuple[int, int], List[int]]
+
+
+@dataclass
+class Completions:
+    '''
+    Class used to autocomplete the names of restaurants, roads and
+    neighbourhoods (see complete). It is a sorted array of keys: the
+    normalized names from the beginning of each of their words, so any word
+    of a name can be completed. It can be updated with update_completions.
+
+    Attributes
+    ----------
+    keys: List[str]
+        Sorted keys
+    names: List[Tuple[str, str]]
+        Name and kind ('restaurant', 'road' or 'neighbourhood') of each key
+    counts: Dict[Tuple[str, str], int]
+        Number of restaurants having each name and kind
+    '''
+    keys: List[str]
+    names: List[Tuple[str, str]]
+    counts: Dict[Tuple[str, str], int]
+
+
 #   *******************
 #   Reading restaurants
 #   *******************
@@ -106,32 +216,68 @@ Restaurants: TypeAlias = List[Restaurant]
 def read() -> Restaurants:
     """
     Reads data from the open data RESTAURANT_FILE file the and returns a list
-    with all the valid Restaurants.
+    with all the valid Restaurants (without repetitions).
     We assume that the restaurant file has the expected format and structure
 
     Returns
     -------
     Restaurants
     """
-    rest_data = pd.read_csv(
-        RESTAURANT_FILE, delimiter=",", encoding='latin-1')
-    rest_lst: Restaurants = []
-    for _, row in rest_data.iterrows():
-        if not rest_lst or row['register_id'] != rest_lst[-1].id:
-            res: Optional[Restaurant] = create_restaurant(row)
-            if res is not None:
-                rest_lst.append(res)
-    return rest_lst
-
-
-def create_restaurant(row: pd.Series) -> Optional[Restaurant]:
+    return [rst for chunk in read_chunks() for rst in chunk]
+
+
+def read_chunks(filename: str = RESTAURANT_FILE,
+                chunksize: int = CHUNK_SIZE) -> Iterator[Restaurants]:
+    """
+    Reads the restaurants of filename (with the format of RESTAURANT_FILE)
+    chunksize rows at a time, reading only the needed columns, so files
+    much bigger than the memory can be read. Yields the new valid
+    restaurants of each chunk: a restaurant repeated in several rows is
+    only created the first time.
+
+    Parameters
+    ----------
+    filename: str
+    chunksize: int
+
+    Returns
+    -------
+    Iterator[Restaurants]
+    """
+    seen: Set[str] = set()
+    for chunk in pd.read_csv(filename, delimiter=",", encoding='latin-1',
+                             usecols=list(DTYPES), dtype=DTYPES,
+                             chunksize=chunksize):
+        rsts: Restaurants = []
+        for row in chunk.to_dict('records'):
+            if row['register_id'] not in seen:
+                seen.add(row['register_id'])
+                res: Optional[Restaurant] = create_restaurant(row)
+                if res is not None:
+                    rsts.append(res)
+        yield rsts
+
+
+def read_index(filename: str = RESTAURANT_FILE,
+               chunksize: int = CHUNK_SIZE) -> RestaurantIndex:
+    """
+    Reads the restaurants of filename in chunks (see read_chunks) and adds
+    each chunk to a RestaurantIndex as it is read.
+    """
+    index: RestaurantIndex = new_index()
+    for rsts in read_chunks(filename, chunksize):
+        add_to_index(index, rsts)
+    return index
+
+
+def create_restaurant(row: Union[pd.Series, Dict]) -> Optional[Restaurant]:
     """
     Creates a restaurant from a row of the read data, returns None if the
     restaurant data is invalid
 
     Parameters
     ----------
-    row: row in a dataframe of containing restaurant data
+    row: row in a dataframe of containing restaurant data (or a dict)
 
     Returns
     -------
@@ -262,16 +408,19 @@ def is_interesting(query: str, res: Restaurant) -> bool:
     bool
     """
 
-    query = normalize_str(query)  # We normalize the query to improve results
+    # We normalize the query to improve results
+    return pattern_in_rst(compile_pattern(normalize_str(query)), res)
+
+
+def pattern_in_rst(pattern: Pattern, res: Restaurant) -> bool:
+    '''
+    Returns whether the compiled pattern is found in any of the fields of a
+    restaurant (see is_interesting)
+    '''
     terms_of_interest = [res.name, res.adress.nb_name,
                          res.adress.dist_name, res.adress.road_name]
-    for t in terms_of_interest:
-        # If the length of the return of find_near_matches is greater than 0
-        # it means that it has found at least one match.
-        if len(find_near_matches(query, normalize_str(t), max_l_dist=MAX_L,
-                                 max_deletions=MAX_DEL)) > 0:
-            return True
-    return False
+    return any(pattern_distance(pattern, normalize_str(t)) is not None
+               for t in terms_of_interest)
 
 
 def search_in_rsts(query: str, rest: Set[Restaurant]) -> Set[Restaurant]:
@@ -279,8 +428,9 @@ def search_in_rsts(query: str, rest: Set[Restaurant]) -> Set[Restaurant]:
     Given a query and a list of restaurants returns a list of the restaurants
     which are "interesting" according to the query
     '''
-    return set([restaurant for restaurant in rest if is_interesting(
-        query, restaurant)])
+    pattern: Pattern = compile_pattern(normalize_str(query))
+    return set([restaurant for restaurant in rest if pattern_in_rst(
+        pattern, restaurant)])
 
 
 def normalize_str(string: str) -> str:
@@ -296,15 +446,457 @@ def normalize_str(string: str) -> str:
     str
 
     '''
-    normalizeMap = {'à': 'a', 'á': 'a', 'ä': 'a',
-                    'è': 'e', 'é': 'e', 'ë': 'e',
-                    'í': 'i', 'ï': 'i',
-                    'ò': 'o', 'ó': 'o', 'ö': 'o',
-                    'ú': 'u', 'ü': 'u',
-                    }
-    return ''.join([normalizeMap.get(c, c) for c in string.lower()])
+    return string.lower().translate(NORMALIZE_TABLE)
+
+
+#   ********************
+#   Approximate matching
+#   ********************
+#   A term matches a text if it can be turned into a substring of the text
+#   with at most MAX_L edits (insertions, deletions or substitutions of a
+#   character), the same as fuzzysearch.find_near_matches with
+#   max_l_dist=MAX_L and max_deletions=MAX_DEL. As only a few edits are
+#   allowed we use Myers' bit-parallel algorithm, which computes a whole
+#   column of the edit distance table with the bits of an integer, and most
+#   texts are discarded before running it.
 
 
+def compile_pattern(term: str, k: int = MAX_L) -> Pattern:
+    '''
+    Compiles a (normalized) search term to find it with up to k edits
+    '''
+    if not term:
+        raise ValueError("Given subsequence is empty!")
+    if not 0 <= k <= 2:
+        raise ValueError("only up to 2 edits are supported")
+    # If none of k+1 disjoint parts of the term is found exactly, k edits are
+    # not enough (one of the parts would be left untouched)
+    size: int = len(term) // (k + 1)
+    pieces: List[str] = [term[i*size:(i+1)*size] for i in range(k)] + \
+        [term[k*size:]] if size > 0 else []
+    peq: Dict[str, int] = {}
+    for i, c in enumerate(term):
+        peq[c] = peq.get(c, 0) | 1 << i
+    return Pattern(term, k, pieces, peq, 1 << (len(term) - 1))
+
+
+def pattern_distance(pattern: Pattern, text: str) -> Optional[int]:
+    '''
+    Returns the fewest edits needed to turn pattern.term into a substring of
+    text, or None if more than pattern.k edits are needed
+    '''
+    if pattern.pieces and not any(p in text for p in pattern.pieces):
+        return None
+    m: int = len(pattern.term)
+    full: int = (1 << m) - 1
+    pv: int = full  # Positions where the column goes up by one
+    mv: int = 0  # Positions where the column goes down by one
+    score: int = m  # Edits of the best substring ending at this character
+    best: int = score
+    for c in text:
+        eq: int = pattern.peq.get(c, 0)
+        xv: int = eq | mv
+        xh: int = (((eq & pv) + pv) ^ pv) | eq
+        ph: int = mv | ~(xh | pv)
+        mh: int = pv & xh
+        if ph & pattern.last:
+            score += 1
+        elif mh & pattern.last:
+            score -= 1
+            if score < best:
+                best = score
+                if best == 0:
+                    return 0
+        ph = (ph << 1) & full
+        mh = (mh << 1) & full
+        pv = (mh | ~(xv | ph)) & full
+        mv = ph & xv
+    return best if best <= pattern.k else None
+
+
+#   *************
+#   Ranked search
+#   *************
+
+
+def parse_query(query: str) -> Query:
+    '''
+    Parses a query of find into a tree, which can be evaluated for each
+    restaurant independently (see match_cost). Text between double quotes
+    is a single term, even if it has commas or parentheses.
+    '''
+    # Pairs (text, quoted)
+    tokens: List[Tuple[str, bool]] = [
+        (quoted, True) if quoted else (plain, False)
+        for quoted, plain in re.findall(r'"([^"]*)"|([^,()"]+)', query)
+        if quoted.strip() or plain.strip()]
+
+    def parse() -> Query:
+        current, quoted = tokens.pop(0)
+        if not quoted and current in ("and", "or"):
+            return (current, parse(), parse())
+        if not quoted and current == "not":
+            return (current, parse())
+        return ('words', [compile_pattern(normalize_str(w))
+                          for w in current.split()])
+    return parse()
+
+
+def word_cost(word: Pattern, fields: Tuple[str, ...]) -> Optional[int]:
+    '''
+    Returns the fewest edits needed to find word in any of the fields, or
+    None if it is not found with the tolerance of is_interesting
+    '''
+    costs: List[int] = [c for c in (pattern_distance(word, field)
+                                    for field in fields) if c is not None]
+    return min(costs) if costs else None
+
+
+def match_cost(query: Query, fields: Tuple[str, ...]) -> Optional[int]:
+    '''
+    Returns None if the restaurant with the given fields does not satisfy
+    the parsed query (with the same meaning as in find), or otherwise the
+    number of edits needed to match it: the sum over the words that have to
+    match, taking the best option of each or.
+    '''
+    if query[0] == 'and':
+        first: Optional[int] = match_cost(query[1], fields)
+        if first is None:
+            return None
+        second: Optional[int] = match_cost(query[2], fields)
+        return None if second is None else first + second
+    if query[0] == 'or':
+        costs: List[int] = [c for c in (match_cost(query[1], fields),
+                                        match_cost(query[2], fields))
+                            if c is not None]
+        return min(costs) if costs else None
+    if query[0] == 'not':
+        return 0 if match_cost(query[1], fields) is None else None
+    if not query[1]:
+        return None  # no elements to search
+    total: int = 0
+    for word in query[1]:
+        cost: Optional[int] = word_cost(word, fields)
+        if cost is None:
+            return None
+        total += cost
+    return total
+
+
+def new_index(max_lat: float = MAX_LAT) -> RestaurantIndex:
+    '''
+    Returns an empty RestaurantIndex for restaurants up to max_lat degrees
+    of latitude (north or south)
+    '''
+    lat_step: float = math.degrees(CELL_SIZE / geo.EARTH_RADIUS)
+    # Parallels are shortest at the highest latitude
+    return RestaurantIndex([], {}, np.empty((0, 2)), [],
+                           (lat_step,
+                            lat_step / math.cos(math.radians(max_lat))), {})
+
+
+def add_to_index(index: RestaurantIndex, rsts: Restaurants) -> None:
+    '''
+    Adds the restaurants of rsts to the index, normalizing their fields
+    once. Restaurants already in the index (same id) are skipped, as in find.
+    '''
+    new: Restaurants = []
+    for rst in rsts:
+        if rst.id not in index.rows:
+            index.rows[rst.id] = len(index.rsts) + len(new)
+            new.append(rst)
+    if not new:
+        return
+    coords: np.ndarray = np.array([rst.coords for rst in new], dtype=float)
+    index.fields += [
+        tuple(normalize_str(t) for t in (rst.name, rst.adress.nb_name,
+                                         rst.adress.dist_name,
+                                         rst.adress.road_name))
+        for rst in new]
+    for row, cell in enumerate(cell_of(index.step, coords).tolist(),
+                               len(index.rsts)):
+        index.cells.setdefault(tuple(cell), []).append(row)
+    index.coords = np.concatenate((index.coords, coords))
+    index.rsts += new
+
+
+def build_index(rsts: Restaurants) -> RestaurantIndex:
+    '''
+    Builds the RestaurantIndex of rsts at once.
+    '''
+    max_lat: float = max((abs(rst.coords[0]) for rst in rsts), default=0.)
+    index: RestaurantIndex = new_index(max_lat)
+    add_to_index(index, rsts)
+    return index
+
+
+def restaurant_changed(old: Restaurant, new: Restaurant) -> bool:
+    '''Returns whether two versions of a restaurant (same id) differ'''
+    return (old.name, old.adress, old.tlf, old.coords) != \
+        (new.name, new.adress, new.tlf, new.coords)
+
+
+def diff(index: RestaurantIndex, rsts: Restaurants) \
+        -> Tuple[Restaurants, List[int], Restaurants]:
+    '''
+    Compares a new version of the restaurants with the ones in index, by id.
+
+    Parameters
+    ----------
+    index: RestaurantIndex
+    rsts: Restaurants
+        New version, without repetitions (see read)
+
+    Returns
+    -------
+    Restaurants
+        Restaurants not in index
+    List[int]
+        Ids of the restaurants of index not in rsts
+    Restaurants
+        New version of the restaurants which have changed
+    '''
+    ids: Set[int] = {rst.id for rst in rsts}
+    added: Restaurants = [rst for rst in rsts if rst.id not in index.rows]
+    removed: List[int] = [rst.id for rst in index.rsts if rst.id not in ids]
+    changed: Restaurants = [
+        rst for rst in rsts if rst.id in index.rows and
+        restaurant_changed(index.rsts[index.rows[rst.id]], rst)]
+    return added, removed, changed
+
+
+def update_index(index: RestaurantIndex, added: Restaurants,
+                 removed: List[int], changed: Restaurants) -> RestaurantIndex:
+    '''
+    Returns a new version of index with the changes found by diff. The
+    index itself is not modified, so searches running on it are not
+    affected: the new version shares everything that has not changed with
+    it and only the modified restaurants are normalized and placed again.
+    '''
+    new: RestaurantIndex = RestaurantIndex(
+        list(index.rsts), dict(index.rows), index.coords.copy(),
+        list(index.fields), index.step, dict(index.cells))
+    copied: Set[Tuple[int, int]] = set()
+
+    def cell_rows(cell: Tuple[int, int]) -> List[int]:
+        # Cell lists are copied before modifying them
+        if cell not in copied:
+            copied.add(cell)
+            new.cells[cell] = list(new.cells.get(cell, []))
+        return new.cells[cell]
+
+    def cell(row: int) -> Tuple[int, int]:
+        return tuple(cell_of(new.step, new.coords[row])[0].tolist())
+
+    for rst in changed:
+        row: int = new.rows[rst.id]
+        old_cell: Tuple[int, int] = cell(row)
+        new.rsts[row] = rst
+        new.coords[row] = rst.coords
+        new.fields[row] = tuple(normalize_str(t) for t in (
+            rst.name, rst.adress.nb_name, rst.adress.dist_name,
+            rst.adress.road_name))
+        if cell(row) != old_cell:
+            cell_rows(old_cell).remove(row)
+            cell_rows(cell(row)).append(row)
+
+    # Each removed restaurant is replaced by the last one
+    for rst_id in removed:
+        row = new.rows.pop(rst_id)
+        last: int = len(new.rsts) - 1
+        cell_rows(cell(row)).remove(row)
+        if row != last:
+            rows: List[int] = cell_rows(cell(last))
+            rows[rows.index(last)] = row
+            new.rsts[row] = new.rsts[last]
+            new.coords[row] = new.coords[last]
+            new.fields[row] = new.fields[last]
+            new.rows[new.rsts[row].id] = row
+        new.rsts.pop()
+        new.fields.pop()
+        new.coords = new.coords[:last]
+    if added:
+        for c in cell_of(new.step, [rst.coords for rst in added]).tolist():
+            cell_rows(tuple(c))
+    add_to_index(new, added)
+    for c in [c for c in copied if not new.cells[c]]:
+        del new.cells[c]
+    return new
+
+
+def cell_of(step: Tuple[float, float], coords: np.ndarray) -> np.ndarray:
+    '''Returns the cell (row, column) of each (lat, lon) in coords'''
+    return np.floor(np.asarray(coords).reshape(-1, 2) / step).astype(int)
+
+
+def ranked_find(query: str, index: RestaurantIndex,
+                loc: Optional[Coord] = None, k: int = TOP_K) -> Restaurants:
+    '''
+    Returns the k best restaurants that satisfy the query (see find),
+    ranked by their distance to loc plus MATCH_PENALTY meters for each edit
+    needed to match the query. The cells of the index are visited in rings
+    around loc, and the search stops as soon as no restaurant in the
+    following rings can have a better score, so far away restaurants are
+    not even matched against the query. Without loc, restaurants are ranked
+    only by the edits.
+
+    Parameters
+    ----------
+    query: str
+    index: RestaurantIndex
+    loc: Optional[Coord]
+        (lat, lon) of the user
+    k: int
+
+    Returns
+    -------
+    Restaurants
+    '''
+    parsed: Query = parse_query(query)
+    if loc is None:
+        costs: List[Tuple[int, int]] = []
+        for row, fields in enumerate(index.fields):
+            cost: Optional[int] = match_cost(parsed, fields)
+            if cost is not None:
+                costs.append((cost, row))
+        return [index.rsts[row] for _, row in heapq.nsmallest(k, costs)]
+
+    # Max heap (with negated scores) of the k best restaurants found
+    best: List[Tuple[float, int]] = []
+    ci, cj = cell_of(index.step, loc)[0].tolist()
+    # Only the cells with restaurants are visited, by rings around loc
+    cells: List[Tuple[int, int]] = list(index.cells)
+    keys: np.ndarray = np.array(cells, dtype=int).reshape(-1, 2)
+    rings: np.ndarray = np.abs(keys - (ci, cj)).max(axis=1)
+    order: np.ndarray = np.argsort(rings, kind='stable')
+    for start, end in zip(*ring_bounds(rings[order])):
+        r: int = int(rings[order[start]])
+        # Restaurants in ring r or farther are at least (r-1) cells away
+        if len(best) == k and -best[0][0] <= (r - 1) * CELL_SIZE:
+            break
+        ring: List[int] = [row for i in order[start:end].tolist()
+                           for row in index.cells[cells[i]]]
+        dists: np.ndarray = geo.one_to_many(loc, index.coords[ring])
+        for row, dist in zip(ring, dists.tolist()):
+            if len(best) == k and dist >= -best[0][0]:
+                continue
+            cost = match_cost(parsed, index.fields[row])
+            if cost is None:
+                continue
+            score: float = dist + MATCH_PENALTY * cost
+            if len(best) < k:
+                heapq.heappush(best, (-score, -row))
+            elif score < -best[0][0]:
+                heapq.heapreplace(best, (-score, -row))
+    return [index.rsts[-row] for _, row in sorted(best, reverse=True)]
+
+
+def ring_bounds(rings: np.ndarray) -> Tuple[List[int], List[int]]:
+    '''
+    Given the sorted rings of the occupied cells, returns where each ring
+    starts and ends in them
+    '''
+    starts: np.ndarray = np.flatnonzero(np.diff(rings, prepend=-1))
+    return starts.tolist(), np.append(starts[1:], len(rings)).tolist()
+
+
+#   ************
+#   Autocomplete
+#   ************
+
+
+def completion_names(rst: Restaurant) -> Set[Tuple[str, str]]:
+    '''Returns the names (with their kind) of rst which can be completed'''
+    return {(rst.name, 'restaurant'), (rst.adress.road_name, 'road'),
+            (rst.adress.nb_name, 'neighbourhood')}
+
+
+def completion_entries(name: str, kind: str) -> List[Tuple[str, str, str]]:
+    '''Returns the (key, name, kind) of every key of a name'''
+    key: str = normalize_str(name)
+    return [(key[m.start():], name, kind) for m in re.finditer(r'\w+', key)]
+
+
+def build_completions(rsts: Restaurants) -> Completions:
+    '''
+    Builds the Completions of the names of the restaurants and of their
+    roads and neighbourhoods.
+    '''
+    counts: Dict[Tuple[str, str], int] = {}
+    for rst in rsts:
+        for name in completion_names(rst):
+            counts[name] = counts.get(name, 0) + 1
+    ordered: List[Tuple[str, str, str]] = sorted(
+        entry for name, kind in counts for entry in
+        completion_entries(name, kind))
+    return Completions([key for key, _, _ in ordered],
+                       [(name, kind) for _, name, kind in ordered], counts)
+
+
+def update_completions(completions: Completions, index: RestaurantIndex,
+                       added: Restaurants, removed: List[int],
+                       changed: Restaurants) -> Completions:
+    '''
+    Returns a new version of completions with the changes found by diff,
+    where index has the old version of the restaurants. Only the keys of the
+    names which no restaurant had, or which no restaurant has anymore, are
+    inserted or deleted (with a binary search). completions is not modified.
+    '''
+    new: Completions = Completions(list(completions.keys),
+                                   list(completions.names),
+                                   dict(completions.counts))
+    old: Restaurants = [index.rsts[index.rows[rst_id]] for rst_id in
+                        removed + [rst.id for rst in changed]]
+    for rst in old:
+        for name in completion_names(rst):
+            new.counts[name] -= 1
+    for rst in added + changed:
+        for name in completion_names(rst):
+            new.counts[name] = new.counts.get(name, 0) + 1
+
+    touched: Set[Tuple[str, str]] = set().union(
+        *(completion_names(rst) for rst in old + added + changed))
+    for name, kind in touched:
+        count: int = new.counts[name, kind]
+        before: int = completions.counts.get((name, kind), 0)
+        if count == 0:
+            del new.counts[name, kind]
+        if (count == 0) == (before == 0):
+            continue
+        for key, _, _ in completion_entries(name, kind):
+            i: int = bisect.bisect_left(new.keys, key)
+            while i < len(new.keys) and new.keys[i] == key and \
+                    new.names[i] < (name, kind):
+                i += 1
+            if count == 0:
+                del new.keys[i], new.names[i]
+            else:
+                new.keys.insert(i, key)
+                new.names.insert(i, (name, kind))
+    return new
+
+
+def complete(prefix: str, completions: Completions,
+             k: int = MAX_COMPLETIONS) -> List[Tuple[str, str]]:
+    '''
+    Returns up to k different names (with their kind) having a word which
+    starts with prefix (see Completions). The keys starting with prefix are
+    consecutive, so they are found with a binary search.
+    '''
+    prefix = normalize_str(prefix).strip()
+    if not prefix:
+        return []
+    found: List[Tuple[str, str]] = []
+    i: int = bisect.bisect_left(completions.keys, prefix)
+    while (i < len(completions.keys) and len(found) < k and
+           completions.keys[i].startswith(prefix)):
+        if completions.names[i] not in found:
+            found.append(completions.names[i])
+        i += 1
+    return found
+
+
+@metrics.timed('yelp')
 def get_yelp_info(rst: Restaurant) -> Optional[Dict[str, str]]:
     '''
         If possible find information about a restaurant using the Yelp API
@@ -368,3 +960,50 @@ def get_info_message(rst: Restaurant) -> Tuple[str, Optional[str]]:
             message += f"\nPreu {extra_info['price']}"
         return message, extra_info["image_url"]
     return message, None
+
+
+#   ***************
+#   Micro-benchmark
+#   ***************
+
+
+def _benchmark() -> None:
+    '''
+    Compares finding some terms in the fields of every restaurant with
+    fuzzysearch and with compiled patterns, and checks that both agree.
+    '''
+    import time
+    from fuzzysearch import find_near_matches
+
+    fields: List[str] = [normalize_str(t) for rst in read() for t in
+                         (rst.name, rst.adress.nb_name,
+                          rst.adress.dist_name, rst.adress.road_name)]
+    terms: List[str] = ['pizza', 'piza', 'sushi', 'gracia', 'grcia', 'bar',
+                        'cafe', 'diagonal', 'diagnoal', 'eixample', 'xina',
+                        'restaurant', 'a', 'tapes', 'kebab', 'zzz']
+
+    t: float = time.perf_counter()
+    slow: List[Optional[int]] = []
+    for term in terms:
+        for field in fields:
+            costs = [m.dist for m in find_near_matches(
+                term, field, max_l_dist=MAX_L, max_deletions=MAX_DEL)]
+            slow.append(min(costs) if costs else None)
+    print('fuzzysearch: %.1f ms' % ((time.perf_counter() - t)*1000))
+    t = time.perf_counter()
+    fast: List[Optional[int]] = []
+    for term in terms:
+        pattern: Pattern = compile_pattern(term)
+        fast.extend(pattern_distance(pattern, field) for field in fields)
+    print('compiled:    %.1f ms' % ((time.perf_counter() - t)*1000))
+    print('%d terms, %d fields' % (len(terms), len(fields)))
+    # fuzzysearch reports terms not longer than MAX_L with their worst
+    # distance (it always matches them with an empty substring)
+    assert [d is None for d in slow] == [d is None for d in fast]
+    assert all(d == e for term, d, e in zip(
+        [term for term in terms for _ in fields], slow, fast)
+        if len(term) > MAX_L)
+
+
+if __name__ == "__main__":
+    _benchmark()